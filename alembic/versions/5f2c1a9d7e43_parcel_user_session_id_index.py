@@ -0,0 +1,34 @@
+"""parcel user_session_id, id index
+
+Revision ID: 5f2c1a9d7e43
+Revises: 3239cbfcd8cb
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '5f2c1a9d7e43'
+down_revision: Union[str, None] = '3239cbfcd8cb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_parcel_user_session_id_id',
+        'parcel',
+        ['user_session_id', 'id'],
+        unique=False
+    )
+
+
+def downgrade() -> None:
+    # MySQL drops the implicit foreign key index once the composite index
+    # covers user_session_id, so restore one before dropping it
+    op.create_index(
+        'ix_parcel_user_session_id', 'parcel', ['user_session_id']
+    )
+    op.drop_index('ix_parcel_user_session_id_id', table_name='parcel')
@@ -0,0 +1,40 @@
+"""parcel filter indexes
+
+Revision ID: 8d41b6e0c2fa
+Revises: 5f2c1a9d7e43
+Create Date: 2026-10-18 11:03:47.915203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '8d41b6e0c2fa'
+down_revision: Union[str, None] = '5f2c1a9d7e43'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'ix_parcel_user_session_id_parcel_type_id_id',
+        'parcel',
+        ['user_session_id', 'parcel_type_id', 'id'],
+        unique=False
+    )
+    # MySQL has no partial indexes, delivery_cost IS NULL is served as
+    # a range scan on (delivery_cost, id) in id order
+    op.create_index(
+        'ix_parcel_delivery_cost_id',
+        'parcel',
+        ['delivery_cost', 'id'],
+        unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_parcel_delivery_cost_id', table_name='parcel')
+    op.drop_index(
+        'ix_parcel_user_session_id_parcel_type_id_id', table_name='parcel'
+    )
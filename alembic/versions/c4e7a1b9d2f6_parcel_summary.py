@@ -0,0 +1,47 @@
+"""parcel summary
+
+Revision ID: c4e7a1b9d2f6
+Revises: 8d41b6e0c2fa
+Create Date: 2026-10-18 12:41:09.538217
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e7a1b9d2f6'
+down_revision: Union[str, None] = '8d41b6e0c2fa'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('parcel_summary',
+    sa.Column('user_session_id', sa.String(length=50), nullable=False),
+    sa.Column('parcel_type_id', sa.Integer(), nullable=False),
+    sa.Column('parcels', sa.Integer(), nullable=False),
+    sa.Column('content_value', sa.Float(), nullable=False),
+    sa.Column('delivery_cost', sa.Float(), nullable=False),
+    sa.Column('unpriced', sa.Integer(), nullable=False),
+    sa.Column('unassigned', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['parcel_type_id'], ['parcel_types.id'], ),
+    sa.ForeignKeyConstraint(['user_session_id'], ['user.session_id'], ),
+    sa.PrimaryKeyConstraint('user_session_id', 'parcel_type_id')
+    )
+    # summaries of the existing parcels
+    op.execute(
+        'INSERT INTO parcel_summary (user_session_id, parcel_type_id, '
+        'parcels, content_value, delivery_cost, unpriced, unassigned) '
+        'SELECT user_session_id, parcel_type_id, COUNT(*), '
+        'COALESCE(SUM(content_value), 0), COALESCE(SUM(delivery_cost), 0), '
+        'SUM(delivery_cost IS NULL), SUM(delivery_company_id IS NULL) '
+        'FROM parcel WHERE user_session_id IS NOT NULL '
+        'GROUP BY user_session_id, parcel_type_id'
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('parcel_summary')
@@ -0,0 +1,46 @@
+"""parcel search index
+
+Revision ID: e2b5d8f3a6c1
+Revises: c4e7a1b9d2f6
+Create Date: 2026-10-18 13:02:27.184406
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b5d8f3a6c1'
+down_revision: Union[str, None] = 'c4e7a1b9d2f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # search pages are ordered by id like the plain listing, so the
+    # (user_session_id, id) index is widened instead of adding one led by
+    # name, which would need a filesort of every match of the user. The
+    # user's entries are walked in id order, the LIKE '%...%' fragment and
+    # the weight and content value ranges are evaluated on them (index
+    # condition pushdown) and the walk stops at the page limit. The whole
+    # name is indexed, not a prefix of it, for the pushdown to apply.
+    # A FULLTEXT index can't be combined with user_session_id and would
+    # match across every user first.
+    op.create_index(
+        'ix_parcel_user_session_id_id_name',
+        'parcel',
+        ['user_session_id', 'id', 'name', 'weight', 'content_value'],
+        unique=False
+    )
+    op.drop_index('ix_parcel_user_session_id_id', table_name='parcel')
+
+
+def downgrade() -> None:
+    # keep an index on the foreign key column at every step
+    op.create_index(
+        'ix_parcel_user_session_id_id',
+        'parcel',
+        ['user_session_id', 'id'],
+        unique=False
+    )
+    op.drop_index('ix_parcel_user_session_id_id_name', table_name='parcel')
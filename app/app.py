@@ -1,19 +1,51 @@
+from contextlib import asynccontextmanager
+
 from fastapi import APIRouter, FastAPI
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.exc import SQLAlchemyError
 
+from app import logger
+from app.cache import redis_client
+from app.db import database
+from app.delivery_costs import delivery_cost_batcher
+from app.middleware.metrics_middleware import MetricsMiddleware
+from app.middleware.rate_limit_middleware import RateLimitMiddleware
 from app.middleware.session_middleware import SessionMiddleware
+from app.repositories import ParcelTypeRepository
+from app.routers.exchange_rate_router import exchange_rate_router
 from app.routers.parcel_router import parcel_router
+from app.routers.service_router import metrics_router, service_router
 from app.settings import settings
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await database.warm_up()
+    # warm up in-process registries, they are lazily reloaded on failure
+    async with database.session_factory() as db_session:
+        try:
+            await ParcelTypeRepository.refresh_registry(db_session, force=True)
+        except SQLAlchemyError as e:
+            logger.error(f'Failed to load parcel types: {e}')
+    yield
+    await delivery_cost_batcher.close()
+    await database.dispose()
+
+
 app = FastAPI(
     title='Delivery service',
     version='0.0.1',
     openapi_version='3.0.0',
     docs_url='/docs/swagger',
-    openapi_url='/docs/openapi.json'
+    openapi_url='/docs/openapi.json',
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 main_routers: tuple[APIRouter, ...] = (
     parcel_router,
+    exchange_rate_router,
+    service_router,
 )
 
 for router in main_routers:
@@ -21,5 +53,14 @@ for router in main_routers:
         router=router,
         prefix=settings.ROOT_PATH
     )
+app.include_router(metrics_router)
 
+app.add_middleware(
+    RateLimitMiddleware,
+    client=redis_client,
+    path_prefix=f'{settings.ROOT_PATH}{parcel_router.prefix}/',
+    capacity=settings.RATE_LIMIT_CAPACITY,
+    refill_per_second=settings.RATE_LIMIT_REFILL_PER_SECOND,
+)
 app.add_middleware(SessionMiddleware)
+app.add_middleware(MetricsMiddleware)
@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Optional
+
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from starlette.responses import Response
+
+from app import logger
+from app.metrics import PARCEL_CACHE_REQUESTS
+from app.settings import settings
+
+redis_client = aioredis.Redis(host=settings.REDIS_HOST, port=6379)
+
+
+# result of a shared call whose caller was cancelled
+LEADER_CANCELLED = object()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key in process: while a call
+    runs, callers with its key wait for it and share its result. If the
+    caller running it is cancelled (e.g. its client went away), the
+    waiters don't fail with it, the first of them to resume runs the call
+    again for the rest.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        while key in self._calls:
+            # a cancelled waiter must not cancel the shared call
+            result = await asyncio.shield(self._calls[key])
+            if result is not LEADER_CANCELLED:
+                return result
+
+        call = asyncio.get_running_loop().create_future()
+        # don't warn about an exception nobody waited for
+        call.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = call
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            # func may depend on the cancelled caller (its request scoped
+            # session), so the waiters run it themselves
+            call.set_result(LEADER_CANCELLED)
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+class ParcelResponseCache:
+    """
+    Read-through cache of parcel read responses.
+
+    All entries of a session live in one redis hash, field name is built
+    from endpoint and query params. A read is a single HMGET and
+    invalidating everything cached for a session is a single DEL.
+    Response body is stored as the already encoded JSON bytes.
+
+    Every invalidate also bumps a per session generation counter. A
+    response is stored only if the generation is still the one read before
+    it was built, so a build that raced with an invalidate can't put back
+    data from before the write.
+    """
+
+    # store the entry only if the generation didn't change since the lookup
+    STORE_SCRIPT = """
+        if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+            return 0
+        end
+        redis.call('HSET', KEYS[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5])
+        redis.call('EXPIRE', KEYS[1], ARGV[6])
+        return 1
+    """
+
+    def __init__(self, client: aioredis.Redis, ttl: int):
+        self.client = client
+        self.ttl = ttl
+        self.single_flight = SingleFlight()
+        self.store = client.register_script(self.STORE_SCRIPT)
+
+    @staticmethod
+    def key(session_id: str) -> str:
+        return f'parcel_cache:{session_id}'
+
+    @staticmethod
+    def generation_key(session_id: str) -> str:
+        return f'parcel_cache_generation:{session_id}'
+
+    @staticmethod
+    def field(endpoint: str, params: dict) -> str:
+        digest = hashlib.sha1(
+            orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+        return f'{endpoint}:{digest}'
+
+    async def get(
+            self,
+            session_id: str,
+            endpoint: str,
+            params: dict
+    ) -> tuple[Optional[Response], Optional[bytes]]:
+        """
+        cached response, None on a miss, and the session generation to
+        pass to set
+        """
+        if not self.ttl:
+            return None, None
+        field = self.field(endpoint, params)
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.hmget(
+                    self.key(session_id), f'{field}:body', f'{field}:headers'
+                )
+                pipe.get(self.generation_key(session_id))
+                (body, headers), generation = await pipe.execute()
+        except RedisError as e:
+            logger.warning(f'Parcel cache unavailable: {e}')
+            return None, None
+        if body is None:
+            PARCEL_CACHE_REQUESTS.labels('miss').inc()
+            return None, generation
+        PARCEL_CACHE_REQUESTS.labels('hit').inc()
+        response = Response(
+            content=body,
+            media_type='application/json',
+            headers=orjson.loads(headers) if headers else None,
+        )
+        return response, generation
+
+    async def set(
+            self,
+            session_id: str,
+            endpoint: str,
+            params: dict,
+            response: Response,
+            generation: Optional[bytes]
+    ) -> None:
+        """
+        cache the response unless the session was invalidated after its
+        generation was read
+        """
+        if not self.ttl:
+            return
+        field = self.field(endpoint, params)
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name not in ('content-length', 'content-type')
+        }
+        try:
+            stored = await self.store(
+                keys=[self.key(session_id), self.generation_key(session_id)],
+                args=[
+                    generation or b'',
+                    f'{field}:body', response.body,
+                    f'{field}:headers', orjson.dumps(headers),
+                    self.ttl,
+                ],
+            )
+        except RedisError as e:
+            logger.warning(f'Parcel cache unavailable: {e}')
+            return
+        if not stored:
+            PARCEL_CACHE_REQUESTS.labels('stale').inc()
+
+    async def get_or_build(
+            self,
+            session_id: str,
+            endpoint: str,
+            params: dict,
+            build: Callable[[], Awaitable[Response]]
+    ) -> Response:
+        """
+        cached response, or the one returned by build, which is cached if
+        successful. Identical concurrent requests of a session share one
+        cache lookup and one build.
+        """
+        async def read_through() -> Response:
+            response, generation = await self.get(
+                session_id, endpoint, params
+            )
+            if response is None:
+                response = await build()
+                if response.status_code == 200:
+                    await self.set(
+                        session_id, endpoint, params, response, generation
+                    )
+            return response
+
+        key = f'{self.key(session_id)}:{self.field(endpoint, params)}'
+        if key in self.single_flight:
+            PARCEL_CACHE_REQUESTS.labels('coalesced').inc()
+        return await self.single_flight.do(key, read_through)
+
+    async def invalidate(self, *session_ids: str) -> None:
+        """
+        drop every cached response of the given sessions and bump their
+        generation, so builds already running don't store their result
+        """
+        if not session_ids:
+            return
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.delete(*map(self.key, session_ids))
+                for session_id in session_ids:
+                    generation_key = self.generation_key(session_id)
+                    pipe.incr(generation_key)
+                    # outlives every entry stored under an older generation
+                    pipe.expire(generation_key, max(self.ttl, 1) * 2)
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(f'Parcel cache unavailable: {e}')
+
+
+parcel_cache = ParcelResponseCache(
+    redis_client, ttl=settings.PARCEL_CACHE_TTL_SECONDS
+)
@@ -1,14 +1,24 @@
 import asyncio
+import threading
+import time
 from datetime import datetime, timedelta
+from typing import Coroutine, Optional
 
-import redis
-import requests
-from celery import Celery
-from celery.signals import beat_init
+from celery import Celery, chord
+from celery.signals import (beat_init, task_postrun, task_prerun, worker_init,
+                            worker_process_init, worker_process_shutdown,
+                            worker_shutdown)
+from prometheus_client import start_http_server
+from sqlalchemy.exc import SQLAlchemyError
 
 from app import logger
-from app.db import database
-from app.repositories import ParcelRepository
+from app.cache import redis_client
+from app.db import database, invalidate_written
+from app.exchange_rates import ExchangeRateUnavailable, exchange_rate_provider
+from app.metrics import (CELERY_TASK_DURATION, DELIVERY_COST_BACKLOG,
+                         metrics_registry)
+from app.repositories import (ParcelRepository, ParcelSummaryRepository,
+                              UserRepository)
 from app.settings import settings
 
 celery = Celery(
@@ -18,33 +28,128 @@ celery = Celery(
     broker_connection_retry_on_startup=True
 )
 
-redis_client = redis.StrictRedis(host=settings.REDIS_HOST, port=6379)
+# last parcel id priced by update_models_with_none_delivery_cost
+DELIVERY_COST_CHECKPOINT_KEY = 'delivery_cost_checkpoint'
 
 
-def get_exchange_rate():
+class WorkerLoop:
     """
-    get exchange rates
-    :return:
+    Event loop of a worker process, running in its own thread for the
+    whole life of the process. The database pool, redis and http
+    connections are bound to it, so they are reused from one task to the
+    next. Sync celery tasks hand their coroutine to run(), which works the
+    same under the prefork, solo and threads pools.
     """
-    response = requests.get('https://www.cbr-xml-daily.ru/daily_json.js')
-    data = response.json()
-    return data['Valute']['USD']['Value']
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self.loop.run_forever,
+                name='worker-event-loop',
+                daemon=True,
+            )
+            self._thread.start()
+
+    def run(self, coro: Coroutine):
+        """
+        run coro on the worker loop and wait for its result
+        """
+        # solo and threads pools don't send worker_process_init
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self, coro: Optional[Coroutine] = None) -> None:
+        """
+        run the cleanup coro, if any, and close the loop
+        """
+        if self.loop is None:
+            # a prefork parent never started its loop, nothing to clean up
+            if coro is not None:
+                coro.close()
+            return
+        try:
+            if coro is not None:
+                self.run(coro)
+            self.run(self.loop.shutdown_asyncgens())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = self._thread = None
+
+
+worker_loop = WorkerLoop()
+
+
+async def open_connections():
+    # pools created by the parent before the fork must not be shared,
+    # dropping them without closing leaves the parent's sockets alone
+    for engine in database.engines:
+        await engine.dispose(close=False)
+    await database.warm_up()
+
+
+async def close_connections():
+    await database.dispose()
+    await exchange_rate_provider.fetcher.close()
+    await redis_client.close()
+
+
+# start times of the running tasks by task id
+task_started: dict[str, float] = {}
+
+
+@worker_init.connect
+def on_worker_init(**kwargs):
+    if settings.CELERY.CELERY_METRICS_PORT:
+        start_http_server(
+            settings.CELERY.CELERY_METRICS_PORT, registry=metrics_registry()
+        )
+
+
+@worker_process_init.connect
+def on_worker_process_init(**kwargs):
+    worker_loop.start()
+    worker_loop.run(open_connections())
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def on_worker_shutdown(**kwargs):
+    worker_loop.stop(close_connections())
+
+
+@task_prerun.connect
+def on_task_prerun(task_id, task, **kwargs):
+    task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def on_task_postrun(task_id, task, state=None, **kwargs):
+    started = task_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(
+            time.perf_counter() - started
+        )
 
 
 @celery.task
 def update_exchange_rate():
-    # get exchange rates
-    exchange_rate = get_exchange_rate()
-
-    # cache to redis for EXCHANGE_RATE_UPDATE_INTERVAL_MINUTES minutes
-    redis_client.set(
-        'usd_exchange_rate',
-        exchange_rate,
-        ex=settings.EXCHANGE_RATE_UPDATE_INTERVAL_MINUTES * 60
-    )
+    # fetch exchange rates and cache them to redis for
+    # EXCHANGE_RATE_UPDATE_INTERVAL_MINUTES minutes
+    exchange_rates = worker_loop.run(exchange_rate_provider.refresh())
 
     logger.info(
-        f'[{datetime.now()}] Updated USD exchange rate: {exchange_rate}'
+        f'[{datetime.now()}] Updated {len(exchange_rates.rates)} exchange '
+        f'rates, USD: {exchange_rates.rates.get("USD")}'
     )
 
 
@@ -67,23 +172,231 @@ def on_beat_init(**kwargs):
                 f' scheduled with task ID: {result.id}')
 
 
+async def on_delivery_cost_chunk(last_id, session_ids):
+    if last_id is not None:
+        await redis_client.set(DELIVERY_COST_CHECKPOINT_KEY, last_id)
+    # cached parcel responses of these users show stale delivery cost
+    await invalidate_written(*session_ids)
+
+
+async def price_new_parcels(parcel_ids: list[int]) -> None:
+    try:
+        exchange_rate = await exchange_rate_provider.get_rate()
+    except ExchangeRateUnavailable as e:
+        # left to the periodic sweep
+        logger.error(f'Exchange rate unavailable: {e.__cause__}')
+        return
+
+    async with database.session_factory() as session:
+        try:
+            priced, session_ids = await (
+                ParcelRepository.calculate_delivery_costs_for_ids(
+                    session, exchange_rate, parcel_ids
+                )
+            )
+        except SQLAlchemyError:
+            logger.error(f'Failed to price parcels {parcel_ids}')
+            return
+
+    await invalidate_written(*session_ids)
+    logger.info(f'Priced {priced} of {len(parcel_ids)} new parcels')
+
+
+@celery.task
+def calculate_delivery_costs_for_ids(parcel_ids: list[int]):
+    """
+    price newly registered parcels, published by the web app right after
+    they are committed
+    """
+    worker_loop.run(price_new_parcels(parcel_ids))
+
+
+async def price_pending_parcels() -> None:
+    try:
+        exchange_rate = await exchange_rate_provider.get_rate()
+    except ExchangeRateUnavailable as e:
+        logger.error(f'Exchange rate unavailable: {e.__cause__}')
+        return
+
+    # resume after the last committed chunk of a killed run
+    start_after = int(
+        await redis_client.get(DELIVERY_COST_CHECKPOINT_KEY) or 0
+    )
+    started = time.monotonic()
+    async with database.session_factory() as session:
+        try:
+            priced = await ParcelRepository.calculate_delivery_costs(
+                session,
+                exchange_rate,
+                batch_size=settings.DELIVERY_COST_BATCH_SIZE,
+                start_after=start_after,
+                on_chunk=on_delivery_cost_chunk,
+            )
+        except SQLAlchemyError:
+            checkpoint = await redis_client.get(DELIVERY_COST_CHECKPOINT_KEY)
+            logger.error(
+                f'Delivery cost calculation stopped, will resume after '
+                f'{checkpoint}'
+            )
+            return
+
+    # every pending parcel is priced, next run starts from the beginning
+    await redis_client.delete(DELIVERY_COST_CHECKPOINT_KEY)
+    elapsed = time.monotonic() - started
+    logger.info(
+        f'Priced {priced} parcels in {elapsed:.2f}s '
+        f'({priced / elapsed if elapsed else 0:.0f} rows/s)'
+    )
+
+
 @celery.task
 def update_models_with_none_delivery_cost():
-    session = database.get_scoped_session()
-    exchange_rate = redis_client.get('usd_exchange_rate')
-    logger.error(f'in redis {exchange_rate}')
-
-    if exchange_rate:
-        logger.debug('from cache')
-        exchange_rate = float(exchange_rate)
-    else:
-        logger.debug('curl')
-        exchange_rate = get_exchange_rate()
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(
-        ParcelRepository.calculate_delivery_costs(session, exchange_rate)
+    worker_loop.run(price_pending_parcels())
+
+
+async def invalidate_priced_sessions(last_id, session_ids):
+    await invalidate_written(*session_ids)
+
+
+async def price_parcel_range(
+        after_id: int, upper_id: Optional[int], exchange_rate: float
+) -> int:
+    async with database.session_factory() as session:
+        try:
+            return await ParcelRepository.calculate_delivery_costs_in_range(
+                session,
+                exchange_rate,
+                after_id,
+                upper_id,
+                on_chunk=invalidate_priced_sessions,
+            )
+        except SQLAlchemyError:
+            # rows left unpriced are picked up by the next sweep
+            logger.error(f'Failed to price parcels in ({after_id}, {upper_id}]')
+            return 0
+
+
+@celery.task
+def calculate_delivery_costs_for_range(
+        after_id: int, upper_id: Optional[int], exchange_rate: float
+) -> int:
+    """
+    shard of the fanned out sweep, prices the unpriced parcels with ids in
+    (after_id, upper_id]
+    :return: number of parcels priced
+    """
+    return worker_loop.run(
+        price_parcel_range(after_id, upper_id, exchange_rate)
     )
-    loop.run_until_complete(session.close())
+
+
+async def plan_delivery_cost_shards() -> Optional[tuple]:
+    """
+    :return: exchange rate and the id ranges of the shards, None if there
+        is nothing to do
+    """
+    try:
+        exchange_rate = await exchange_rate_provider.get_rate()
+    except ExchangeRateUnavailable as e:
+        logger.error(f'Exchange rate unavailable: {e.__cause__}')
+        return None
+    async with database.session_factory() as session:
+        try:
+            ranges = await ParcelRepository.unpriced_id_ranges(
+                session, settings.DELIVERY_COST_SHARD_SIZE
+            )
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            return None
+    return (exchange_rate, ranges) if ranges else None
+
+
+@celery.task
+def dispatch_delivery_cost_shards():
+    """
+    fanned out sweep: split unpriced parcels into id ranges and price each
+    range in its own task, so every worker takes part. All shards use the
+    exchange rate read here.
+    """
+    plan = worker_loop.run(plan_delivery_cost_shards())
+    if plan is None:
+        return
+    exchange_rate, ranges = plan
+    chord(
+        calculate_delivery_costs_for_range.s(after_id, upper_id, exchange_rate)
+        for after_id, upper_id in ranges
+    )(finish_delivery_cost_shards.s(time.time()))
+    logger.info(f'Dispatched {len(ranges)} delivery cost shards')
+
+
+@celery.task
+def finish_delivery_cost_shards(priced: list[int], started: float):
+    elapsed = time.time() - started
+    logger.info(
+        f'Priced {sum(priced)} parcels in {len(priced)} shards in '
+        f'{elapsed:.2f}s ({sum(priced) / elapsed if elapsed else 0:.0f} '
+        f'rows/s)'
+    )
+
+
+async def count_pending_parcels() -> None:
+    async with database.session_factory() as session:
+        try:
+            backlog = await ParcelRepository.count_without_delivery_cost(
+                session
+            )
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            return
+    DELIVERY_COST_BACKLOG.set(backlog)
+
+
+@celery.task
+def measure_delivery_cost_backlog():
+    worker_loop.run(count_pending_parcels())
+
+
+async def rebuild_summaries(session_ids: Optional[list[str]]) -> None:
+    """
+    rebuild the summaries of the given users, or of all of them in batches
+    of PARCEL_SUMMARY_REBUILD_BATCH_SIZE users, each in its own transaction
+    """
+    batch_size = settings.PARCEL_SUMMARY_REBUILD_BATCH_SIZE
+    batches = 0
+    after = None
+    while True:
+        async with database.session_factory() as session:
+            try:
+                batch = session_ids
+                if batch is None:
+                    batch = await UserRepository.session_ids_after(
+                        session, after, batch_size
+                    )
+                if batch:
+                    await ParcelSummaryRepository.rebuild(session, batch)
+                    await session.commit()
+            except SQLAlchemyError as e:
+                logger.error(f'An error occurred: {e}')
+                return
+        if not batch:
+            break
+        await invalidate_written(*batch)
+        batches += 1
+        if session_ids is not None or len(batch) < batch_size:
+            break
+        after = batch[-1]
+    logger.info(f'Rebuilt parcel summaries in {batches} batches')
+
+
+@celery.task
+def rebuild_parcel_summaries(session_ids: Optional[list[str]] = None):
+    """
+    recompute parcel summaries from the parcel table to repair drift, of
+    the given users or of all of them. Not scheduled, run it by hand, e.g.
+        celery -A app.celery_worker call \\
+            app.celery_worker.rebuild_parcel_summaries
+    """
+    worker_loop.run(rebuild_summaries(session_ids))
 
 
 celery.conf.beat_schedule = {
@@ -94,8 +407,17 @@ celery.conf.beat_schedule = {
         ),  # each EXCHANGE_RATE_UPDATE_INTERVAL_MINUTES minutes
     },
     'update_models_with_none_delivery_cost': {
-        'task': 'app.celery_worker.update_models_with_none_delivery_cost',
-        # try to update after currency rate is refreshed
+        'task': 'app.celery_worker.dispatch_delivery_cost_shards'
+        if settings.DELIVERY_COST_SHARD_SIZE
+        else 'app.celery_worker.update_models_with_none_delivery_cost',
+        # safety net for parcels whose calculate_delivery_costs_for_ids
+        # task was lost or ran without an exchange rate
+        'schedule': timedelta(
+            minutes=settings.DELIVERY_COST_SWEEP_INTERVAL_MINUTES
+        ),
+    },
+    'measure_delivery_cost_backlog': {
+        'task': 'app.celery_worker.measure_delivery_cost_backlog',
         'schedule': timedelta(minutes=1),
     },
 }
@@ -1,43 +1,403 @@
-from asyncio import current_task
+import asyncio
+import time
+from typing import Optional, Sequence
 
-from sqlalchemy.ext.asyncio import (AsyncEngine, async_scoped_session,
-                                    async_sessionmaker, create_async_engine)
+from prometheus_client import REGISTRY
+from redis.exceptions import RedisError
+from sqlalchemy import Table, event, exc, insert, select, text
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.ext.asyncio import (AsyncEngine, async_sessionmaker,
+                                    create_async_engine)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.requests import Request
 
-from app.settings import settings
+from app import logger
+from app.cache import parcel_cache, redis_client
+from app.metrics import PoolCollector, instrument_engine
+from app.settings import DBConfig, settings
+
+RECENT_WRITE_KEY = 'db_recent_write:{}'
+# connection info key of the server's auto_increment_increment
+AUTO_INCREMENT_STEP_KEY = 'auto_increment_increment'
+
+
+class InsertedIdsUnknown(exc.SQLAlchemyError):
+    """
+    ids of a multi-row INSERT could not be derived from its lastrowid
+    """
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that records how long checkouts take to get a connection,
+    which includes waiting for one to be returned when the pool and its
+    overflow are exhausted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+            'max_overflow': self._max_overflow,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_seconds_total': self.wait_seconds_total,
+            'wait_seconds_max': self.wait_seconds_max,
+        }
+
+
+class UnitOfWork:
+    """
+    One transaction per request. Repositories only flush, which is enough
+    to get generated ids, and the handler commits once when all of its
+    writes are done. Whatever is not committed is rolled back when the
+    request ends.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.committed = False
+
+    async def commit(self) -> None:
+        await self.session.commit()
+        self.committed = True
+
+    async def rollback(self) -> None:
+        await self.session.rollback()
+
+
+class ReplicaSet:
+    """
+    Read replica engines handed out round robin. A replica that fails to
+    give a connection, or drops one, is skipped for retry_after seconds.
+    """
+
+    def __init__(self, engines: Sequence[AsyncEngine], retry_after: float):
+        self.engines = list(engines)
+        self.retry_after = retry_after
+        self._next = 0
+        self._down_until = [0.0] * len(self.engines)
+        for index, engine in enumerate(self.engines):
+            event.listen(
+                engine.sync_engine, 'handle_error', self._on_error(index)
+            )
+
+    def _on_error(self, index: int):
+        def handle_error(context):
+            # connect failures come without a connection
+            if context.is_disconnect or context.connection is None:
+                self.mark_down(index)
+        return handle_error
+
+    def mark_down(self, index: int) -> None:
+        self._down_until[index] = time.monotonic() + self.retry_after
+
+    def candidates(self) -> list[tuple[int, AsyncEngine]]:
+        """
+        healthy replicas, starting from the next one in turn
+        """
+        if not self.engines:
+            return []
+        now = time.monotonic()
+        start = self._next
+        self._next = (start + 1) % len(self.engines)
+        order = [*range(start, len(self.engines)), *range(start)]
+        return [
+            (index, self.engines[index]) for index in order
+            if self._down_until[index] <= now
+        ]
 
 
 class DatabaseClient:
-    def __init__(self, url: str, echo: bool = False):
-        self.engine: AsyncEngine = create_async_engine(
-            url=url,
-            echo=echo,
+    def __init__(
+            self,
+            url: str,
+            config: DBConfig,
+            replica_urls: Sequence[str] = (),
+            replica_retry_seconds: float = 30,
+            read_your_writes_seconds: int = 0,
+    ):
+        self.config = config
+        self.engine: AsyncEngine = self._create_engine(url)
+        self.replicas = ReplicaSet(
+            [self._create_engine(replica) for replica in replica_urls],
+            retry_after=replica_retry_seconds,
         )
+        self.read_your_writes_seconds = read_your_writes_seconds
         self.session_factory = async_sessionmaker(
             bind=self.engine,
             autoflush=False,
             autocommit=False,
+            # committed objects stay readable without a reload round trip
+            expire_on_commit=False,
         )
 
-    def get_scoped_session(self):
-        session = async_scoped_session(
-            session_factory=self.session_factory,
-            scopefunc=current_task,
+    def _create_engine(self, url: str) -> AsyncEngine:
+        engine = create_async_engine(
+            url=url,
+            echo=self.config.echo,
+            poolclass=MeteredQueuePool,
+            pool_size=self.config.pool_size,
+            max_overflow=self.config.max_overflow,
+            pool_timeout=self.config.pool_timeout,
+            pool_recycle=self.config.pool_recycle,
+            pool_pre_ping=self.config.pool_pre_ping,
         )
-        return session
+        instrument_engine(engine.sync_engine)
+        return engine
+
+    @property
+    def engines(self) -> list[AsyncEngine]:
+        return [self.engine, *self.replicas.engines]
+
+    async def warm_up(self) -> None:
+        """
+        open pool_size connections up front so the first requests after a
+        start don't pay for the handshakes
+        """
+        async def ping(engine: AsyncEngine):
+            async with engine.connect() as connection:
+                await connection.execute(text('SELECT 1'))
 
-    async def scoped_session_dependency(self) -> AsyncSession:
-        session = self.get_scoped_session()
+        results = await asyncio.gather(
+            *(
+                ping(engine) for engine in self.engines
+                for _ in range(self.config.pool_size)
+            ),
+            return_exceptions=True,
+        )
+        errors = [e for e in results if isinstance(e, Exception)]
+        if errors:
+            logger.error(f'Database warm up failed: {errors[0]}')
+
+    async def dispose(self) -> None:
+        for engine in self.engines:
+            await engine.dispose()
+
+    @staticmethod
+    def _pool_stats(engine: AsyncEngine) -> dict:
+        pool = engine.sync_engine.pool
+        if isinstance(pool, MeteredQueuePool):
+            return pool.stats()
+        return {'status': pool.status()}
+
+    def pool_stats(self) -> dict:
+        stats = self._pool_stats(self.engine)
+        if self.replicas.engines:
+            stats['replicas'] = [
+                self._pool_stats(engine) for engine in self.replicas.engines
+            ]
+        return stats
+
+    async def mark_written(self, *session_ids: str) -> None:
+        """
+        route reads of the sessions to the primary for the read-your-writes
+        window, so they see their own writes despite replication lag
+        """
+        if (
+            not self.replicas.engines
+            or not self.read_your_writes_seconds
+            or not session_ids
+        ):
+            return
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for session_id in session_ids:
+                    pipe.set(
+                        RECENT_WRITE_KEY.format(session_id), 1,
+                        ex=self.read_your_writes_seconds,
+                    )
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(f'Failed to record write of {session_ids}: {e}')
+
+    async def _recently_wrote(self, session_id: Optional[str]) -> bool:
+        if not self.read_your_writes_seconds or session_id is None:
+            return False
+        try:
+            return bool(
+                await redis_client.exists(RECENT_WRITE_KEY.format(session_id))
+            )
+        except RedisError as e:
+            logger.warning(f'Failed to check writes of {session_id}: {e}')
+            return True
+
+    async def read_session(
+            self,
+            session_id: Optional[str] = None
+    ) -> AsyncSession:
+        """
+        session bound to a healthy replica, falls back to the primary when
+        there are none or the session wrote within the read-your-writes
+        window
+        """
+        if self.replicas.engines and not await self._recently_wrote(
+            session_id
+        ):
+            for index, engine in self.replicas.candidates():
+                session = self.session_factory(bind=engine)
+                try:
+                    # check out now so a dead replica is skipped up front
+                    await session.connection()
+                    return session
+                except exc.DBAPIError as e:
+                    logger.warning(f'Read replica {index} unavailable: {e}')
+                    self.replicas.mark_down(index)
+                    await session.close()
+        return self.session_factory()
+
+    async def read_session_dependency(self, request: Request) -> AsyncSession:
+        session = await self.read_session(request.state.session_id)
         try:
             yield session
-        # todo: too wide
-        except Exception:
-            await session.rollback()
         finally:
             await session.close()
 
+    async def unit_of_work_dependency(self) -> UnitOfWork:
+        session = self.session_factory()
+        uow = UnitOfWork(session)
+        try:
+            yield uow
+        finally:
+            if session.in_transaction() and not uow.committed:
+                await uow.rollback()
+            await session.close()
+
+
+async def invalidate_written(*session_ids: str) -> None:
+    """
+    after a commit changing parcels of the sessions, send their reads to
+    the primary and drop their cached responses, in that order: a read
+    after the invalidate can't be served by a replica that lacks the write
+    and cache it, one already running on a replica read the generation
+    the invalidate bumps and isn't stored. Reads go back to the replicas
+    after DB_READ_YOUR_WRITES_SECONDS, a replica lagging longer than that
+    can still have its stale rows cached for PARCEL_CACHE_TTL_SECONDS.
+    """
+    await database.mark_written(*session_ids)
+    await parcel_cache.invalidate(*session_ids)
+
+
+def upsert_statement(
+        db_session: AsyncSession,
+        table: Table,
+        rows: list[dict],
+        keys: Sequence[str],
+        increment: Sequence[str] = ()
+):
+    """
+    multi-row INSERT that leaves existing rows alone, or adds the
+    increment columns of the new row to them
+    :param keys: columns of the unique key the rows may collide on
+    """
+    if db_session.bind.dialect.name == 'sqlite':
+        # local benchmarks run on sqlite
+        stmt = sqlite.insert(table).values(rows)
+        if not increment:
+            return stmt.on_conflict_do_nothing()
+        return stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={
+                name: table.c[name] + stmt.excluded[name]
+                for name in increment
+            },
+        )
+    stmt = mysql.insert(table).values(rows)
+    if not increment:
+        return stmt.on_duplicate_key_update({
+            name: stmt.inserted[name] for name in keys
+        })
+    return stmt.on_duplicate_key_update({
+        name: table.c[name] + stmt.inserted[name] for name in increment
+    })
+
+
+async def insert_returning_ids(
+        db_session: AsyncSession, table: Table, rows: list[dict]
+) -> list[int]:
+    """
+    insert rows with one multi-row INSERT
+    :return: ids of the rows in input order
+    """
+    if db_session.bind.dialect.name == 'sqlite':
+        # local benchmarks run on sqlite, where lastrowid is the last id
+        res = await db_session.execute(
+            insert(table).returning(table.c.id, sort_by_parameter_order=True),
+            rows,
+        )
+        return list(res.scalars())
+    # InnoDB reserves the ids of a multi-row INSERT of known size as one
+    # block, spaced by auto_increment_increment, lastrowid is the first of
+    # them. That holds in every innodb_autoinc_lock_mode but is not
+    # promised by MySQL, so the derived ids are checked before use.
+    connection = await db_session.connection()
+    step = connection.info.get(AUTO_INCREMENT_STEP_KEY)
+    if step is None:
+        step = connection.info[AUTO_INCREMENT_STEP_KEY] = int(
+            await connection.scalar(text('SELECT @@auto_increment_increment'))
+        )
+    res = await db_session.execute(insert(table).values(rows))
+    if res.rowcount != len(rows):
+        raise InsertedIdsUnknown(
+            f'inserted {res.rowcount} of {len(rows)} rows into {table.name}'
+        )
+    ids = list(range(
+        res.lastrowid, res.lastrowid + len(rows) * step, step
+    ))
+    # read back, each id has to hold the row at its position. Floats are
+    # left out, FLOAT columns don't return the inserted double
+    columns = [
+        name for name, value in rows[0].items()
+        if not isinstance(value, float)
+    ]
+    found = {
+        row['id']: row for row in (await db_session.execute(
+            select(table.c.id, *(table.c[name] for name in columns)).where(
+                table.c.id.in_(ids)
+            )
+        )).mappings()
+    }
+    for row_id, row in zip(ids, rows):
+        stored = found.get(row_id)
+        if stored is None or any(
+            stored[name] != row[name] for name in columns
+        ):
+            raise InsertedIdsUnknown(
+                f'ids of {len(rows)} rows inserted into {table.name} from '
+                f'{res.lastrowid} by {step} are not contiguous'
+            )
+    return ids
+
 
 database = DatabaseClient(
     url=settings.DB_URL,
-    echo=settings.DB.echo,
+    config=settings.DB,
+    replica_urls=settings.DB_REPLICA_URLS,
+    replica_retry_seconds=settings.DB_REPLICA_RETRY_SECONDS,
+    read_your_writes_seconds=settings.DB_READ_YOUR_WRITES_SECONDS,
 )
+pool_collector = PoolCollector(database.pool_stats)
+REGISTRY.register(pool_collector)
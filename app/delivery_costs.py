@@ -0,0 +1,80 @@
+import asyncio
+from typing import Callable, Iterable, Optional
+
+from kombu.exceptions import OperationalError
+
+from app import logger
+from app.celery_worker import calculate_delivery_costs_for_ids
+from app.settings import settings
+
+
+class DeliveryCostBatcher:
+    """
+    Collects ids of newly committed parcels and publishes them to the
+    delivery cost task in batches, once per interval or as soon as
+    max_size ids are queued, so a burst of registrations costs a few
+    messages instead of one per parcel.
+    """
+
+    def __init__(
+            self,
+            publish: Callable[[list[int]], None],
+            interval: float,
+            max_size: int,
+    ):
+        self.publish = publish
+        self.interval = interval
+        self.max_size = max_size
+        self._ids: list[int] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def add(self, parcel_ids: Iterable[int]) -> None:
+        self._ids.extend(parcel_ids)
+        if len(self._ids) >= self.max_size:
+            self._spawn(self.flush())
+        elif self._ids and self._timer is None:
+            self._timer = self._spawn(self._flush_later())
+
+    def _spawn(self, coro) -> asyncio.Task:
+        # keep a reference until done, the loop holds tasks only weakly
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.interval)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        ids, self._ids = self._ids, []
+        for start in range(0, len(ids), self.max_size):
+            chunk = ids[start:start + self.max_size]
+            try:
+                # publishing is blocking broker io
+                await asyncio.to_thread(self.publish, chunk)
+            except OperationalError as e:
+                # the sweep prices them later
+                logger.error(f'Failed to publish {len(chunk)} parcels: {e}')
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def publish_parcel_ids(parcel_ids: list[int]) -> None:
+    # fail fast, the ids are not lost for good if the broker is down
+    calculate_delivery_costs_for_ids.apply_async((parcel_ids,), retry=False)
+
+
+delivery_cost_batcher = DeliveryCostBatcher(
+    publish_parcel_ids,
+    interval=settings.DELIVERY_COST_PUBLISH_INTERVAL_MS / 1000,
+    max_size=settings.DELIVERY_COST_BATCH_SIZE,
+)
@@ -0,0 +1,212 @@
+import asyncio
+from time import monotonic
+from typing import Optional, Protocol
+
+import aiohttp
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+from app import logger
+from app.cache import redis_client
+from app.metrics import EXCHANGE_RATE_LOOKUPS
+from app.pydantic_models.pydantic_models import ExchangeRatesPD
+from app.settings import settings
+
+# hash of currency code -> rate plus the provider timestamp field
+EXCHANGE_RATES_KEY = 'exchange_rates'
+EXCHANGE_RATES_LOCK_KEY = 'exchange_rates:lock'
+TIMESTAMP_FIELD = '_timestamp'
+
+
+class ExchangeRateUnavailable(Exception):
+    pass
+
+
+class RateFetcher(Protocol):
+    async def fetch(self) -> ExchangeRatesPD:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class CBRRateFetcher:
+    """
+    Downloads the CBR daily JSON rate table over one pooled aiohttp
+    session with explicit timeouts.
+    """
+
+    def __init__(self, url: str, timeout: float):
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+
+    async def fetch(self) -> ExchangeRatesPD:
+        async with self.session.get(self.url) as response:
+            response.raise_for_status()
+            # cbr serves json as application/javascript
+            data = await response.json(content_type=None)
+        # cbr quotes some currencies per 10 or 100 units
+        rates = {
+            code: float(valute['Value']) / valute['Nominal']
+            for code, valute in data['Valute'].items()
+        }
+        rates['RUB'] = 1.0
+        return ExchangeRatesPD(timestamp=data['Timestamp'], rates=rates)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class ExchangeRateProvider:
+    """
+    Exchange rate table cached in process on top of the redis
+    exchange_rates hash, which is filled from the fetcher. A single
+    download serves every currency and a redis read is one HGETALL.
+
+    Only one caller per process refreshes at a time, the others wait for
+    it or get the previous value while it is inside the stale grace
+    window. Across processes a redis lock lets a single one hit the
+    fetcher while the rest wait for the key to appear.
+    """
+
+    def __init__(
+            self,
+            client: aioredis.Redis,
+            fetcher: RateFetcher,
+            local_ttl: float,
+            redis_ttl: int,
+            stale_grace: float,
+            lock_timeout: float,
+    ):
+        self.client = client
+        self.fetcher = fetcher
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.stale_grace = stale_grace
+        self.lock_timeout = lock_timeout
+        self._lock = asyncio.Lock()
+        self._value: Optional[ExchangeRatesPD] = None
+        self._loaded_at = float('-inf')
+
+    def _age(self) -> float:
+        return monotonic() - self._loaded_at
+
+    def _set(self, value: ExchangeRatesPD) -> ExchangeRatesPD:
+        self._value = value
+        self._loaded_at = monotonic()
+        return value
+
+    async def get_rate(self, currency: str = 'USD') -> float:
+        """
+        :return: rubles per one unit of currency
+        """
+        try:
+            return (await self.get_rates()).rates[currency]
+        except KeyError as e:
+            raise ExchangeRateUnavailable() from e
+
+    async def get_rates(self) -> ExchangeRatesPD:
+        if self._value is not None and self._age() < self.local_ttl:
+            EXCHANGE_RATE_LOOKUPS.labels('local').inc()
+            return self._value
+        stale = self._age() < self.local_ttl + self.stale_grace
+        if self._lock.locked() and stale:
+            EXCHANGE_RATE_LOOKUPS.labels('stale').inc()
+            return self._value
+        async with self._lock:
+            if self._value is not None and self._age() < self.local_ttl:
+                EXCHANGE_RATE_LOOKUPS.labels('local').inc()
+                return self._value
+            try:
+                return await self._load()
+            except (
+                aiohttp.ClientError, asyncio.TimeoutError, RedisError,
+                KeyError, ValueError,
+            ) as e:
+                if self._value is not None and stale:
+                    logger.warning(f'Serving stale exchange rate: {e}')
+                    EXCHANGE_RATE_LOOKUPS.labels('stale').inc()
+                    return self._value
+                raise ExchangeRateUnavailable() from e
+
+    async def refresh(self) -> ExchangeRatesPD:
+        """
+        fetch rates from the source and publish them to redis
+        """
+        async with self._lock:
+            rates = await self.fetcher.fetch()
+            await self._publish(rates)
+            return self._set(rates)
+
+    async def _publish(self, rates: ExchangeRatesPD) -> None:
+        # replace the whole table atomically
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(EXCHANGE_RATES_KEY)
+            pipe.hset(
+                EXCHANGE_RATES_KEY,
+                mapping={**rates.rates, TIMESTAMP_FIELD: rates.timestamp},
+            )
+            pipe.expire(EXCHANGE_RATES_KEY, self.redis_ttl)
+            await pipe.execute()
+
+    async def _read(self) -> Optional[ExchangeRatesPD]:
+        cached = await self.client.hgetall(EXCHANGE_RATES_KEY)
+        if not cached:
+            return None
+        timestamp = cached.pop(TIMESTAMP_FIELD.encode()).decode()
+        return ExchangeRatesPD(
+            timestamp=timestamp,
+            rates={
+                code.decode(): float(rate) for code, rate in cached.items()
+            },
+        )
+
+    async def _load(self) -> ExchangeRatesPD:
+        cached = await self._read()
+        if cached is not None:
+            EXCHANGE_RATE_LOOKUPS.labels('redis').inc()
+            return self._set(cached)
+
+        acquired = await self.client.set(
+            EXCHANGE_RATES_LOCK_KEY, 1, nx=True,
+            ex=max(1, int(self.lock_timeout))
+        )
+        if not acquired:
+            # another process is fetching, wait for it to publish the rate
+            deadline = monotonic() + self.lock_timeout
+            while monotonic() < deadline:
+                await asyncio.sleep(0.1)
+                cached = await self._read()
+                if cached is not None:
+                    EXCHANGE_RATE_LOOKUPS.labels('redis').inc()
+                    return self._set(cached)
+        EXCHANGE_RATE_LOOKUPS.labels('fetch').inc()
+        try:
+            rates = await self.fetcher.fetch()
+            await self._publish(rates)
+        finally:
+            if acquired:
+                await self.client.delete(EXCHANGE_RATES_LOCK_KEY)
+        return self._set(rates)
+
+
+exchange_rate_provider = ExchangeRateProvider(
+    redis_client,
+    CBRRateFetcher(
+        settings.CBR_API_URL,
+        timeout=settings.EXCHANGE_RATE_FETCH_TIMEOUT_SECONDS,
+    ),
+    local_ttl=settings.EXCHANGE_RATE_LOCAL_TTL_SECONDS,
+    redis_ttl=settings.EXCHANGE_RATE_UPDATE_INTERVAL_MINUTES * 60,
+    stale_grace=settings.EXCHANGE_RATE_STALE_GRACE_SECONDS,
+    lock_timeout=settings.EXCHANGE_RATE_FETCH_TIMEOUT_SECONDS * 2,
+)
@@ -0,0 +1,150 @@
+import functools
+import inspect
+import os
+import time
+from contextvars import ContextVar
+from typing import Callable
+
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'HTTP request latency',
+    ['method', 'route', 'status'],
+)
+DB_QUERY_DURATION = Histogram(
+    'db_query_duration_seconds',
+    'Database statement execution time',
+    ['operation'],
+)
+EXCHANGE_RATE_LOOKUPS = Counter(
+    'exchange_rate_lookups',
+    'Exchange rate lookups by where they were served from',
+    ['source'],
+)
+CELERY_TASK_DURATION = Histogram(
+    'celery_task_duration_seconds',
+    'Celery task run time',
+    ['task', 'state'],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600),
+)
+PARCEL_CACHE_REQUESTS = Counter(
+    'parcel_cache_requests',
+    'Parcel read cache lookups by result',
+    ['result'],
+)
+DELIVERY_COST_BACKLOG = Gauge(
+    'delivery_cost_backlog',
+    'Parcels without delivery cost',
+    multiprocess_mode='livemax',
+)
+
+# repository method issuing the current statements
+db_operation: ContextVar[str] = ContextVar('db_operation', default='other')
+
+
+def timed_operation(func: Callable) -> Callable:
+    """
+    label statements executed by the decorated repository method with its
+    qualified name in DB_QUERY_DURATION
+    """
+    name = func.__qualname__
+
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def generator_wrapper(*args, **kwargs):
+            # streams are consumed in their own task, nothing to restore
+            db_operation.set(name)
+            async for item in func(*args, **kwargs):
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = db_operation.set(name)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            db_operation.reset(token)
+    return wrapper
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    observe every statement of the engine in DB_QUERY_DURATION
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        context.query_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        DB_QUERY_DURATION.labels(db_operation.get()).observe(
+            time.perf_counter() - context.query_started
+        )
+
+
+class PoolCollector:
+    """
+    connection pool figures of DatabaseClient.pool_stats, read on scrape
+    """
+
+    def __init__(self, pool_stats: Callable[[], dict]):
+        self.pool_stats = pool_stats
+
+    def collect(self):
+        stats = self.pool_stats()
+        pools = [('primary', stats)] + [
+            (f'replica{index}', replica)
+            for index, replica in enumerate(stats.get('replicas', ()))
+        ]
+        gauges = {
+            name: GaugeMetricFamily(
+                f'db_pool_{name}', f'Pool connections {name}', labels=['pool']
+            )
+            for name in ('size', 'checked_in', 'checked_out', 'overflow')
+        }
+        counters = {
+            name: CounterMetricFamily(
+                f'db_pool_{name}', description, labels=['pool']
+            )
+            for name, description in (
+                ('checkouts', 'Connections handed out'),
+                ('timeouts', 'Checkouts failed waiting for a connection'),
+                ('wait_seconds', 'Time spent getting connections'),
+            )
+        }
+        for pool, values in pools:
+            for name, metric in gauges.items():
+                if name in values:
+                    metric.add_metric([pool], values[name])
+            for name, metric in counters.items():
+                key = 'wait_seconds_total' if name == 'wait_seconds' else name
+                if key in values:
+                    metric.add_metric([pool], values[key])
+        yield from gauges.values()
+        yield from counters.values()
+
+
+def metrics_registry(*process_collectors) -> CollectorRegistry:
+    """
+    registry to expose, aggregated over processes when
+    PROMETHEUS_MULTIPROC_DIR is set for multiple uvicorn workers or the
+    celery prefork pool
+    :param process_collectors: custom collectors of the serving process,
+        already registered in the default registry
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    for collector in process_collectors:
+        registry.register(collector)
+    return registry
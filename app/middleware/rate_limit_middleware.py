@@ -0,0 +1,95 @@
+import math
+import time
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app import logger
+from app.middleware.session_middleware import read_session_cookie
+
+# KEYS[1] bucket hash, ARGV capacity, refill per second, now, cost
+# returns whether the request is allowed and the seconds to wait if not
+TOKEN_BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(retry_after)}
+'''
+
+
+class RateLimitMiddleware:
+    """
+    Pure ASGI token bucket limiter for requests under path_prefix, one
+    bucket per session_id cookie, or per client address for requests
+    without one. Buckets live in redis and are updated by a Lua script, so
+    the limit holds across worker processes. When redis is unavailable
+    requests are let through.
+    """
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            client: aioredis.Redis,
+            path_prefix: str,
+            capacity: int,
+            refill_per_second: float,
+    ):
+        self.app = app
+        self.path_prefix = path_prefix
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    @staticmethod
+    def bucket_key(scope: Scope) -> str:
+        session_id = read_session_cookie(scope)
+        if session_id:
+            return f'rate_limit:{session_id}'
+        client = scope.get('client')
+        return f'rate_limit:addr:{client[0] if client else ""}'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope['type'] != 'http'
+            or not scope['path'].startswith(self.path_prefix)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            allowed, retry_after = await self.script(
+                keys=[self.bucket_key(scope)],
+                args=[
+                    self.capacity, self.refill_per_second, time.time(), 1
+                ],
+            )
+        except RedisError as e:
+            logger.warning(f'Rate limiter unavailable: {e}')
+            allowed = True
+        if allowed:
+            await self.app(scope, receive, send)
+            return
+
+        response = JSONResponse(
+            status_code=429,
+            content='Too many requests',
+            headers={'Retry-After': str(math.ceil(float(retry_after)))},
+        )
+        await response(scope, receive, send)
@@ -1,28 +1,60 @@
 import secrets
-from datetime import datetime, timedelta
 
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+SESSION_COOKIE = 'session_id'
+SESSION_MAX_AGE = 365 * 24 * 60 * 60
 
-class SessionMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        # Check if the user has a session ID cookie
-        session_id = request.cookies.get('session_id')
+_COOKIE_PREFIX = f'{SESSION_COOKIE}='
+# Max-Age keeps the Set-Cookie attributes constant for every new session
+_SET_COOKIE_SUFFIX = f'; Max-Age={SESSION_MAX_AGE}; Path=/; SameSite=lax'
 
-        # If not, generate a new one
-        if not session_id:
-            # Generate a unique session ID
-            session_id = secrets.token_hex(16)
-            response = await call_next(request)
-            cookie_expires = (
-                    datetime.utcnow() + timedelta(days=365)
-            ).strftime('%a, %d %b %Y %H:%M:%S GMT')
-            response.set_cookie(
-                key='session_id',
-                value=session_id,
-                expires=cookie_expires
-            )
 
-            return response
+def read_session_cookie(scope: Scope):
+    for name, value in scope['headers']:
+        if name == b'cookie':
+            for cookie in value.decode('latin-1').split(';'):
+                cookie = cookie.strip()
+                if cookie.startswith(_COOKIE_PREFIX):
+                    return cookie[len(_COOKIE_PREFIX):] or None
+    return None
 
-        return await call_next(request)
+
+class SessionMiddleware:
+    """
+    Pure ASGI middleware assigning every client a session_id cookie.
+    The id is exposed to handlers as request.state.session_id, responses
+    pass through untouched apart from the Set-Cookie header of new sessions.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        session_id = read_session_cookie(scope)
+        state = scope.setdefault('state', {})
+        if session_id:
+            state['session_id'] = session_id
+            await self.app(scope, receive, send)
+            return
+
+        # Generate a unique session ID
+        session_id = secrets.token_hex(16)
+        state['session_id'] = session_id
+        set_cookie = (
+            b'set-cookie',
+            f'{_COOKIE_PREFIX}{session_id}{_SET_COOKIE_SUFFIX}'.encode(),
+        )
+
+        async def send_with_cookie(message: Message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [
+                    *message.get('headers', ()), set_cookie
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
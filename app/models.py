@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Float, ForeignKey, Integer, String
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -39,6 +39,22 @@ class Parcel(Base):
     user = relationship('User', back_populates='parcels')
     parcel_type = relationship('ParcelType', backref='parcels')
 
+    __table_args__ = (
+        # keyset pagination of user parcels and parcel search: walked in
+        # id order, name fragment and ranges are checked on the index
+        Index(
+            'ix_parcel_user_session_id_id_name',
+            'user_session_id', 'id', 'name', 'weight', 'content_value'
+        ),
+        # user parcels filtered by type
+        Index(
+            'ix_parcel_user_session_id_parcel_type_id_id',
+            'user_session_id', 'parcel_type_id', 'id'
+        ),
+        # pending delivery cost scan, IS NULL is a range on this index
+        Index('ix_parcel_delivery_cost_id', 'delivery_cost', 'id'),
+    )
+
 
 class Company(Base):
     __tablename__ = 'companies'
@@ -46,3 +62,29 @@ class Company(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(255), unique=True)
     parcels = relationship('Parcel', back_populates='company')
+
+
+# ParcelSummary columns holding totals
+SUMMARY_COUNTERS = (
+    'parcels', 'content_value', 'delivery_cost', 'unpriced', 'unassigned'
+)
+
+
+class ParcelSummary(Base):
+    """
+    per user and parcel type totals, kept up to date by the writes to
+    parcel so the summary of a user is read without scanning its parcels
+    """
+    __tablename__ = 'parcel_summary'
+
+    user_session_id = Column(
+        String(50), ForeignKey('user.session_id'), primary_key=True
+    )
+    parcel_type_id = Column(
+        Integer, ForeignKey('parcel_types.id'), primary_key=True
+    )
+    parcels = Column(Integer, nullable=False, default=0)
+    content_value = Column(Float, nullable=False, default=0)
+    delivery_cost = Column(Float, nullable=False, default=0)
+    unpriced = Column(Integer, nullable=False, default=0)
+    unassigned = Column(Integer, nullable=False, default=0)
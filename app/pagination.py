@@ -0,0 +1,23 @@
+import base64
+import json
+from typing import Optional
+
+
+def encode_cursor(last_id: int) -> str:
+    """
+    build opaque cursor pointing after the given parcel id
+    """
+    payload = json.dumps({'id': last_id}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Optional[int]:
+    """
+    :return: parcel id the cursor points after, None if the cursor is invalid
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        last_id = json.loads(payload)['id']
+    except (ValueError, TypeError, KeyError):
+        return None
+    return last_id if isinstance(last_id, int) else None
@@ -10,6 +10,17 @@ class EParcelType(Enum):
     miscellaneous = 'miscellaneous'
 
 
+class EExportFormat(Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class EAssignResult(Enum):
+    won = 'won'
+    lost = 'lost'
+    not_found = 'not_found'
+
+
 class UserPD(BaseModel):
     session_id: str
 
@@ -33,6 +44,11 @@ class ParcelPD(BaseModel):
         return v
 
 
+class AssignCompanyBatchPD(BaseModel):
+    company_id: int
+    parcel_ids: list[int]
+
+
 class ParcelDetailResponse(BaseModel):
     id: Optional[int] = None
     name: str
@@ -41,3 +57,45 @@ class ParcelDetailResponse(BaseModel):
     content_value: float
     delivery_cost: Union[float, str]
     delivery_company_id: Union[float, str] = None
+
+
+class ParcelTypePD(BaseModel):
+    id: int
+    name: str
+
+
+class ExchangeRatesPD(BaseModel):
+    # provider timestamp of the rates
+    timestamp: str
+    # rubles per one unit of currency, keyed by ISO code
+    rates: dict[str, float]
+
+
+class TariffRulePD(BaseModel):
+    # conditions, unset ones match any parcel
+    parcel_type: Optional[EParcelType] = None
+    company_id: Optional[int] = None
+    # weight band, lower bound inclusive and upper bound exclusive
+    min_weight: float = 0
+    max_weight: Optional[float] = None
+
+    # price = (base + weight price + content_value * content_rate) * rate
+    base: float = 0
+    content_rate: float = 0
+    per_kg: float = 0
+    # (up to weight, price) pairs in ascending weight order replacing
+    # weight * per_kg, per_kg is then charged above the last step only
+    weight_steps: Optional[list[tuple[float, float]]] = None
+
+    @field_validator('weight_steps')
+    def weight_steps_validator(
+            cls,
+            v: Optional[list[tuple[float, float]]]
+    ) -> Optional[list[tuple[float, float]]]:
+        if v is not None:
+            weights = [weight for weight, _ in v]
+            if not weights or weights != sorted(set(weights)):
+                raise ValueError(
+                    'Weight steps should be non empty and ascending'
+                )
+        return v
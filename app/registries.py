@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from time import monotonic
+from typing import Iterable, Optional
+
+from app.pydantic_models.pydantic_models import ParcelTypePD
+from app.settings import settings
+
+
+class ParcelTypeRegistry:
+    """
+    In-process copy of the parcel_types table indexed by name and by id.
+    The table mirrors EParcelType and almost never changes, so it is loaded
+    once and reloaded only after ttl seconds or an explicit invalidate().
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.lock = asyncio.Lock()
+        self.etag: Optional[str] = None
+        self._by_name: dict[str, ParcelTypePD] = {}
+        self._by_id: dict[int, ParcelTypePD] = {}
+        self._loaded_at: Optional[float] = None
+
+    @property
+    def is_stale(self) -> bool:
+        return (
+            self._loaded_at is None
+            or monotonic() - self._loaded_at > self.ttl
+        )
+
+    def update(self, parcel_types: Iterable) -> None:
+        """
+        replace registry content
+        :param parcel_types: objects with id and name attributes
+        """
+        items = sorted(
+            (ParcelTypePD(id=item.id, name=item.name) for item in parcel_types),
+            key=lambda item: item.id,
+        )
+        self._by_name = {item.name: item for item in items}
+        self._by_id = {item.id: item for item in items}
+        digest = hashlib.sha1(
+            ';'.join(f'{item.id}:{item.name}' for item in items).encode()
+        ).hexdigest()
+        self.etag = f'"{digest}"'
+        self._loaded_at = monotonic()
+
+    def invalidate(self) -> None:
+        """
+        force reload on next access, call after parcel_types is modified
+        """
+        self._loaded_at = None
+
+    def get_by_name(self, name: str) -> Optional[ParcelTypePD]:
+        return self._by_name.get(name)
+
+    def get_by_id(self, parcel_type_id: int) -> Optional[ParcelTypePD]:
+        return self._by_id.get(parcel_type_id)
+
+    def all(self) -> list[ParcelTypePD]:
+        return list(self._by_id.values())
+
+
+class KnownSessionRegistry:
+    """
+    LRU set of session ids whose user row is known to be committed,
+    returning users skip the user upsert entirely.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._session_ids: OrderedDict[str, None] = OrderedDict()
+
+    def __contains__(self, session_id: str) -> bool:
+        if session_id in self._session_ids:
+            self._session_ids.move_to_end(session_id)
+            return True
+        return False
+
+    def add(self, session_id: str) -> None:
+        self._session_ids[session_id] = None
+        self._session_ids.move_to_end(session_id)
+        if len(self._session_ids) > self.maxsize:
+            self._session_ids.popitem(last=False)
+
+
+class CompanyRegistry:
+    """
+    In-process set of existing company ids, reloaded after ttl seconds.
+    Only presence is trusted, an id missing from it may belong to a company
+    added since the last load.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._ids: set[int] = set()
+        self._loaded_at: Optional[float] = None
+
+    @property
+    def is_stale(self) -> bool:
+        return (
+            self._loaded_at is None
+            or monotonic() - self._loaded_at > self.ttl
+        )
+
+    def update(self, company_ids: Iterable[int]) -> None:
+        self._ids = set(company_ids)
+        self._loaded_at = monotonic()
+
+    def __contains__(self, company_id: int) -> bool:
+        return company_id in self._ids
+
+    def add(self, company_id: int) -> None:
+        self._ids.add(company_id)
+
+
+parcel_type_registry = ParcelTypeRegistry(ttl=settings.PARCEL_TYPES_TTL_SECONDS)
+known_sessions = KnownSessionRegistry(
+    maxsize=settings.KNOWN_SESSIONS_CACHE_SIZE
+)
+company_registry = CompanyRegistry(ttl=settings.COMPANIES_TTL_SECONDS)
@@ -1,63 +1,289 @@
-from sqlalchemy import select, text, update
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import numpy as np
+from sqlalchemy import (bindparam, case, delete, event, func, insert, select,
+                        update)
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
 
 from app import logger
-from app.models import Parcel, ParcelType, User
-from app.pydantic_models.pydantic_models import EParcelType, ParcelPD
+from app.db import insert_returning_ids, upsert_statement
+from app.metrics import timed_operation
+from app.models import (SUMMARY_COUNTERS, Company, Parcel, ParcelSummary,
+                        ParcelType, User)
+from app.pydantic_models.pydantic_models import (EAssignResult, EParcelType,
+                                                 ParcelPD, ParcelTypePD)
+from app.registries import (company_registry, known_sessions,
+                            parcel_type_registry)
+from app.settings import settings
+from app.tariffs import NO_COMPANY, tariff_engine
+
+# session.info key of user rows upserted in the current transaction
+PENDING_SESSIONS_KEY = 'pending_user_sessions'
+
+
+class CompanyNotFound(Exception):
+    pass
 
 
 class UserRepository:
 
     @staticmethod
-    async def get_or_create(db_session: AsyncSession, session_id) -> User:
+    @timed_operation
+    async def upsert(db_session: AsyncSession, session_id: str) -> None:
+        """
+        make sure the user row exists with a single idempotent statement,
+        without committing so it joins the caller's transaction
+        """
+        if session_id in known_sessions:
+            return
+        stmt = upsert_statement(
+            db_session, User.__table__, [{'session_id': session_id}],
+            keys=['session_id'],
+        )
+        logger.debug(f'upserting user: {session_id}')
+        await db_session.execute(stmt)
+        # remembered as known only once the transaction commits
+        db_session.info.setdefault(PENDING_SESSIONS_KEY, set()).add(
+            session_id
+        )
+
+    @staticmethod
+    @timed_operation
+    async def session_ids_after(
+            db_session: AsyncSession, after: Optional[str], limit: int
+    ) -> list[str]:
+        """
+        :return: next limit session ids in key order, from the first one
+            if after is None
+        """
+        stmt = select(User.session_id).order_by(User.session_id).limit(limit)
+        if after is not None:
+            stmt = stmt.where(User.session_id > after)
+        return list(await db_session.scalars(stmt))
+
+
+@event.listens_for(Session, 'after_commit')
+def remember_committed_sessions(session: Session) -> None:
+    for session_id in session.info.pop(PENDING_SESSIONS_KEY, ()):
+        known_sessions.add(session_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back_sessions(session: Session) -> None:
+    session.info.pop(PENDING_SESSIONS_KEY, None)
+
+
+def summary_aggregates() -> dict:
+    """
+    :return: summary column -> aggregate over parcel rows
+    """
+    return {
+        'parcels': func.count(),
+        'content_value': func.coalesce(func.sum(Parcel.content_value), 0),
+        'delivery_cost': func.coalesce(func.sum(Parcel.delivery_cost), 0),
+        'unpriced': func.sum(
+            case((Parcel.delivery_cost.is_(None), 1), else_=0)
+        ),
+        'unassigned': func.sum(
+            case((Parcel.delivery_company_id.is_(None), 1), else_=0)
+        ),
+    }
+
+
+class ParcelSummaryRepository:
+
+    @staticmethod
+    async def increment(db_session: AsyncSession, deltas: list[dict]) -> None:
+        """
+        add deltas to the summary rows, creating missing ones
+        :param deltas: user_session_id, parcel_type_id and counter deltas,
+            missing counters are left unchanged
+        """
+        if not deltas:
+            return
+        table = ParcelSummary.__table__
+        # a fixed order keeps concurrent upserts from deadlocking
+        rows = sorted(
+            (
+                {**dict.fromkeys(SUMMARY_COUNTERS, 0), **delta}
+                for delta in deltas
+            ),
+            key=lambda row: (row['user_session_id'], row['parcel_type_id']),
+        )
+        await db_session.execute(upsert_statement(
+            db_session, table, rows,
+            keys=['user_session_id', 'parcel_type_id'],
+            increment=SUMMARY_COUNTERS,
+        ))
+
+    @staticmethod
+    async def add_from_parcels(
+            db_session: AsyncSession, conditions: list, **aggregates
+    ) -> list[dict]:
+        """
+        add aggregates of the parcels matching conditions to the summaries
+        of their users and types
+        :param aggregates: summary column -> aggregate over the parcels
+        :return: deltas per user and type, including parcels without a
+            user, which have no summary
+        """
+        stmt = select(
+            Parcel.user_session_id,
+            Parcel.parcel_type_id,
+            *(
+                aggregate.label(name)
+                for name, aggregate in aggregates.items()
+            ),
+        ).where(*conditions).group_by(
+            Parcel.user_session_id, Parcel.parcel_type_id
+        )
+        deltas = [
+            dict(row) for row in (await db_session.execute(stmt)).mappings()
+        ]
+        await ParcelSummaryRepository.increment(db_session, [
+            delta for delta in deltas if delta['user_session_id'] is not None
+        ])
+        return deltas
+
+    @staticmethod
+    @timed_operation
+    async def get_by_session_id(
+            db_session: AsyncSession, session_id: str
+    ) -> list:
+        """
+        :return: (ParcelSummary, ParcelType) rows of the user
+        """
+        stmt = select(ParcelSummary, ParcelType).join(
+            ParcelType, ParcelSummary.parcel_type_id == ParcelType.id
+        ).where(
+            ParcelSummary.user_session_id == session_id
+        ).order_by(ParcelSummary.parcel_type_id)
         try:
-            instance_q = select(User).where(User.session_id == session_id)
-            instance = await db_session.scalar(instance_q)
-            logger.debug(f'instance: {instance}')
-            logger.debug(f'session: {session_id}')
-            if instance:
-                logger.debug('user found, returning...')
-                return instance
-            else:
-                instance = User(session_id=session_id)
-                logger.debug(f'creating user: {instance}')
-                db_session.add(instance)
-                await db_session.commit()
-                await db_session.refresh(instance)
-                return instance
+            return (await db_session.execute(stmt)).all()
         except SQLAlchemyError as e:
             logger.error(f'An error occurred: {e}')
-            await db_session.rollback()
+            raise
+
+    @staticmethod
+    @timed_operation
+    async def rebuild(
+            db_session: AsyncSession, session_ids: list[str]
+    ) -> None:
+        """
+        recompute summaries of the given users from the parcel table,
+        commit is up to the caller. Only their summary and parcel rows are
+        locked, larger repairs go through it in batches
+        """
+        table = ParcelSummary.__table__
+        aggregates = summary_aggregates()
+        await db_session.execute(
+            delete(table).where(table.c.user_session_id.in_(session_ids))
+        )
+        await db_session.execute(
+            insert(table).from_select(
+                ['user_session_id', 'parcel_type_id', *aggregates],
+                select(
+                    Parcel.user_session_id,
+                    Parcel.parcel_type_id,
+                    *aggregates.values(),
+                ).where(
+                    Parcel.user_session_id.in_(session_ids)
+                ).group_by(
+                    Parcel.user_session_id, Parcel.parcel_type_id
+                ),
+            )
+        )
 
 
 class ParcelRepository:
 
     @staticmethod
+    @timed_operation
     async def create(
             db_session: AsyncSession,
             parcel_instance: ParcelPD,
-            parcel_type: int,
+            parcel_type: ParcelTypePD,
             user_session_id: str
     ) -> Parcel:
         parcel = Parcel(
             name=parcel_instance.name,
             weight=parcel_instance.weight,
-            parcel_type=parcel_type,
+            parcel_type_id=parcel_type.id,
             content_value=parcel_instance.content_cost,
             user_session_id=user_session_id
         )
         logger.debug(f'creating parcel: {parcel}')
         try:
             db_session.add(parcel)
-            await db_session.commit()
-            await db_session.refresh(parcel)
+            # flush assigns the autoincrement id, commit is up to the caller
+            await db_session.flush()
+            await ParcelSummaryRepository.increment(db_session, [{
+                'user_session_id': user_session_id,
+                'parcel_type_id': parcel_type.id,
+                'parcels': 1,
+                'content_value': parcel.content_value,
+                'unpriced': 1,
+                'unassigned': 1,
+            }])
             return parcel
         except SQLAlchemyError as e:
             logger.error(f'An error occurred: {e}')
-            await db_session.rollback()
+            raise
 
     @staticmethod
+    @timed_operation
+    async def create_many(
+            db_session: AsyncSession,
+            parcels: list[tuple[ParcelPD, int]],
+            user_session_id: str
+    ) -> list[int]:
+        """
+        insert parcels with multi-row INSERTs, commit is up to the caller
+        :param parcels: (parcel, parcel type id) pairs
+        :return: created ids in input order
+        """
+        rows = [
+            {
+                'name': parcel.name,
+                'weight': parcel.weight,
+                'parcel_type_id': parcel_type_id,
+                'content_value': parcel.content_cost,
+                'user_session_id': user_session_id,
+            }
+            for parcel, parcel_type_id in parcels
+        ]
+        chunk_size = settings.PARCEL_BATCH_INSERT_SIZE
+        ids = []
+        try:
+            for start in range(0, len(rows), chunk_size):
+                ids.extend(await insert_returning_ids(
+                    db_session, Parcel.__table__,
+                    rows[start:start + chunk_size],
+                ))
+            deltas = {}
+            for row in rows:
+                delta = deltas.setdefault(row['parcel_type_id'], {
+                    'user_session_id': user_session_id,
+                    'parcel_type_id': row['parcel_type_id'],
+                    'parcels': 0,
+                    'content_value': 0,
+                })
+                delta['parcels'] += 1
+                delta['content_value'] += row['content_value']
+            for delta in deltas.values():
+                delta['unpriced'] = delta['unassigned'] = delta['parcels']
+            await ParcelSummaryRepository.increment(
+                db_session, list(deltas.values())
+            )
+            return ids
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            raise
+
+    @staticmethod
+    @timed_operation
     async def get_all_by_session_id(
         db_session: AsyncSession,
         session_id,
@@ -77,19 +303,110 @@ class ParcelRepository:
             if has_delivery_cost:
                 stmt = stmt.filter(Parcel.delivery_cost.isnot(None))
             if parcel_type:
-                stmt = stmt.filter(ParcelType.name == parcel_type.name)
+                # filter on parcel.parcel_type_id to stay on the
+                # (user_session_id, parcel_type_id, id) index
+                known_type = await ParcelTypeRepository.get_by_name(
+                    db_session, parcel_type
+                )
+                stmt = stmt.filter(
+                    Parcel.parcel_type_id == known_type.id
+                    if known_type
+                    else ParcelType.name == parcel_type.name
+                )
 
-            stmt = stmt.limit(pagination['limit']).offset(
-                pagination['skip_pages']
+            result = await db_session.execute(
+                ParcelRepository.paginate(stmt, pagination)
             )
+            return result.all()
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            return []
 
-            result = await db_session.execute(stmt)
+    @staticmethod
+    def paginate(stmt, pagination: dict):
+        # keyset paging on (user_session_id, id) when a cursor is given,
+        # plain offset is kept for clients still sending skip_pages
+        stmt = stmt.order_by(Parcel.id)
+        if pagination.get('after_id') is not None:
+            stmt = stmt.filter(Parcel.id > pagination['after_id'])
+        elif pagination['skip_pages']:
+            stmt = stmt.offset(pagination['skip_pages'])
+        return stmt.limit(pagination['limit'])
+
+    @staticmethod
+    @timed_operation
+    async def search_by_session_id(
+        db_session: AsyncSession,
+        session_id: str,
+        pagination: dict,
+        name: str = None,
+        min_weight: float = None,
+        max_weight: float = None,
+        min_content_value: float = None,
+        max_content_value: float = None,
+    ):
+        """
+        user parcels whose name contains the fragment, within the weight and
+        content value ranges (bounds included). The user's entries of the
+        (user_session_id, id, name, weight, content_value) index are walked
+        in page order and every filter is checked on them, only matching
+        rows are read from the table.
+        """
+        try:
+            stmt = select(Parcel, ParcelType).join(
+                ParcelType, ParcelType.id == Parcel.parcel_type_id
+            ).filter(Parcel.user_session_id == session_id)
+            if name:
+                stmt = stmt.filter(Parcel.name.contains(name, autoescape=True))
+            for column, lower, upper in (
+                (Parcel.weight, min_weight, max_weight),
+                (Parcel.content_value, min_content_value, max_content_value),
+            ):
+                if lower is not None:
+                    stmt = stmt.filter(column >= lower)
+                if upper is not None:
+                    stmt = stmt.filter(column <= upper)
+
+            result = await db_session.execute(
+                ParcelRepository.paginate(stmt, pagination)
+            )
             return result.all()
         except SQLAlchemyError as e:
             logger.error(f'An error occurred: {e}')
             return []
 
     @staticmethod
+    @timed_operation
+    async def stream_by_session_id(
+        db_session: AsyncSession,
+        session_id: str,
+        yield_per: int = None
+    ) -> AsyncIterator[list]:
+        """
+        stream all user parcels through a server side cursor. Errors are
+        raised, so a response streaming the rows is aborted instead of
+        ending as if the export was complete
+        :return: async iterator of (Parcel, ParcelType) row partitions
+        """
+        stmt = (
+            select(Parcel, ParcelType).join(
+                ParcelType, ParcelType.id == Parcel.parcel_type_id
+            ).filter(
+                Parcel.user_session_id == session_id
+            ).order_by(Parcel.id).execution_options(
+                yield_per=yield_per or settings.PARCEL_EXPORT_YIELD_PER
+            )
+        )
+        try:
+            result = await db_session.stream(stmt)
+            async for partition in result.partitions():
+                yield partition
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            raise
+
+    @staticmethod
+    @timed_operation
     async def get_full_info_by_id(
             db_session: AsyncSession,
             session_id: str,
@@ -110,32 +427,319 @@ class ParcelRepository:
             logger.error(f'An error occurred: {e}')
 
     @staticmethod
+    @timed_operation
+    async def get_session_ids(
+            db_session: AsyncSession,
+            parcel_ids: list[int]
+    ) -> list[str]:
+        """
+        :return: distinct user session ids owning the given parcels
+        """
+        try:
+            stmt = select(Parcel.user_session_id).where(
+                Parcel.id.in_(parcel_ids)
+            ).distinct()
+            result = await db_session.scalars(stmt)
+            return result.all()
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            return []
+
+    @staticmethod
+    async def price_parcels(
+            db_session: AsyncSession,
+            exchange_rate: float,
+            conditions: list
+    ) -> int:
+        """
+        set delivery cost of the parcels matching conditions, in a single
+        UPDATE when the tariff rules compile to SQL, otherwise priced in
+        one numpy pass and written back with one executemany
+        :return: number of parcels priced
+        """
+        await ParcelTypeRepository.refresh_registry(db_session)
+        clause = tariff_engine.sql_clause(exchange_rate)
+        if clause is not None:
+            # summaries take the costs before the rows stop matching
+            deltas = await ParcelSummaryRepository.add_from_parcels(
+                db_session,
+                conditions,
+                unpriced=-func.count(),
+                delivery_cost=func.sum(clause),
+            )
+            res = await db_session.execute(
+                update(Parcel).where(*conditions).values(
+                    delivery_cost=clause
+                ).execution_options(synchronize_session=False)
+            )
+            if res.rowcount != -sum(delta['unpriced'] for delta in deltas):
+                # rows priced concurrently in between, recount the owners
+                await ParcelSummaryRepository.rebuild(db_session, [
+                    delta['user_session_id'] for delta in deltas
+                    if delta['user_session_id'] is not None
+                ])
+            return res.rowcount
+
+        # locked until commit, so the guarded UPDATE below matches every
+        # row the summary deltas are computed from, rows being priced by
+        # another transaction are left to it
+        rows = (await db_session.execute(
+            select(
+                Parcel.id, Parcel.parcel_type_id, Parcel.weight,
+                Parcel.content_value, Parcel.delivery_company_id,
+                Parcel.user_session_id,
+            ).where(*conditions).with_for_update(skip_locked=True)
+        )).all()
+        if not rows:
+            return 0
+        (
+            ids, parcel_type_ids, weights, content_values, company_ids,
+            session_ids,
+        ) = zip(*rows)
+        costs = tariff_engine.price(
+            np.array(parcel_type_ids),
+            np.array(weights),
+            np.array(content_values),
+            np.array([company_id or NO_COMPANY for company_id in company_ids]),
+            exchange_rate,
+        )
+        table = Parcel.__table__
+        await db_session.execute(
+            update(table).where(
+                table.c.id == bindparam('parcel_id'),
+                table.c.delivery_cost.is_(None)
+            ).values(delivery_cost=bindparam('cost')),
+            [
+                {'parcel_id': parcel_id, 'cost': cost}
+                for parcel_id, cost in zip(ids, costs.tolist())
+            ],
+        )
+        deltas = {}
+        for key, cost in zip(zip(session_ids, parcel_type_ids), costs.tolist()):
+            if key[0] is None:
+                continue
+            delta = deltas.setdefault(key, {
+                'user_session_id': key[0],
+                'parcel_type_id': key[1],
+                'delivery_cost': 0,
+                'unpriced': 0,
+            })
+            delta['delivery_cost'] += cost
+            delta['unpriced'] -= 1
+        await ParcelSummaryRepository.increment(
+            db_session, list(deltas.values())
+        )
+        return len(rows)
+
+    @staticmethod
+    @timed_operation
+    async def count_without_delivery_cost(db_session: AsyncSession) -> int:
+        """
+        :return: number of parcels waiting for delivery cost
+        """
+        return await db_session.scalar(
+            select(func.count()).select_from(Parcel).where(
+                Parcel.delivery_cost.is_(None)
+            )
+        )
+
+    @staticmethod
+    async def nth_unpriced_id(
+            db_session: AsyncSession, after_id: int, n: int
+    ) -> Optional[int]:
+        """
+        :return: id of the n-th unpriced parcel after after_id, None if
+            there are fewer left
+        """
+        # read from the (delivery_cost, id) index only
+        return await db_session.scalar(
+            select(Parcel.id).where(
+                Parcel.delivery_cost.is_(None),
+                Parcel.id > after_id
+            ).order_by(Parcel.id).offset(n - 1).limit(1)
+        )
+
+    @staticmethod
+    @timed_operation
+    async def unpriced_id_ranges(
+            db_session: AsyncSession, range_size: int
+    ) -> list[tuple[int, Optional[int]]]:
+        """
+        split unpriced parcels into consecutive id ranges of range_size
+        parcels each
+        :return: (id the range starts after, last id of the range) pairs,
+            the last range is open ended with None as its last id
+        """
+        first_id = await db_session.scalar(
+            select(func.min(Parcel.id)).where(Parcel.delivery_cost.is_(None))
+        )
+        if first_id is None:
+            return []
+        ranges = []
+        last_id = first_id - 1
+        while last_id is not None:
+            upper_id = await ParcelRepository.nth_unpriced_id(
+                db_session, last_id, range_size
+            )
+            ranges.append((last_id, upper_id))
+            last_id = upper_id
+        return ranges
+
+    @staticmethod
+    @timed_operation
     async def calculate_delivery_costs(
             db_session: AsyncSession,
-            exchange_rate: float
-    ):
+            exchange_rate: float,
+            batch_size: int = None,
+            start_after: int = 0,
+            on_chunk: Callable[
+                [Optional[int], list[str]], Awaitable[None]
+            ] = None
+    ) -> int:
+        """
+        calculate delivery cost of unpriced parcels in id range chunks,
+        committing after each one so row locks are held only briefly
+        :param start_after: parcel id to resume after
+        :param on_chunk: awaited after every committed chunk with its last id
+            (None for the final, open ended chunk) and the user session ids
+            whose parcels were priced
+        :return: number of parcels priced
+        """
+        batch_size = batch_size or settings.DELIVERY_COST_BATCH_SIZE
+        last_id = start_after
+        priced = 0
         try:
-            stmt = update(Parcel).where(
-                Parcel.delivery_cost.is_(None)).values(
-                delivery_cost=(
-                    Parcel.weight * 0.5 + Parcel.content_value * 0.01
-                ) * exchange_rate
+            while last_id is not None:
+                upper_id = await ParcelRepository.nth_unpriced_id(
+                    db_session, last_id, batch_size
+                )
+                conditions = [
+                    Parcel.delivery_cost.is_(None), Parcel.id > last_id
+                ]
+                if upper_id is not None:
+                    conditions.append(Parcel.id <= upper_id)
+                session_ids = (await db_session.scalars(
+                    select(Parcel.user_session_id).where(
+                        *conditions
+                    ).distinct()
+                )).all()
+                priced += await ParcelRepository.price_parcels(
+                    db_session, exchange_rate, conditions
+                )
+                await db_session.commit()
+                last_id = upper_id
+                if on_chunk:
+                    await on_chunk(upper_id, session_ids)
+            return priced
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            await db_session.rollback()
+            raise
+
+    @staticmethod
+    @timed_operation
+    async def calculate_delivery_costs_in_range(
+            db_session: AsyncSession,
+            exchange_rate: float,
+            after_id: int,
+            upper_id: Optional[int],
+            batch_size: int = None,
+            on_chunk: Callable[
+                [Optional[int], list[str]], Awaitable[None]
+            ] = None
+    ) -> int:
+        """
+        calculate delivery cost of unpriced parcels in an id range, chunk by
+        chunk. Every chunk is claimed with FOR UPDATE SKIP LOCKED, so
+        workers running overlapping ranges skip each other's rows instead of
+        waiting for them or pricing them twice
+        :param after_id: id the range starts after
+        :param upper_id: last id of the range, None for no upper bound
+        :param on_chunk: awaited after every committed chunk with its last id
+            and the user session ids whose parcels were priced
+        :return: number of parcels priced
+        """
+        batch_size = batch_size or settings.DELIVERY_COST_BATCH_SIZE
+        last_id = after_id
+        priced = 0
+        try:
+            while True:
+                conditions = [
+                    Parcel.delivery_cost.is_(None), Parcel.id > last_id
+                ]
+                if upper_id is not None:
+                    conditions.append(Parcel.id <= upper_id)
+                claimed = (await db_session.execute(
+                    select(Parcel.id, Parcel.user_session_id).where(
+                        *conditions
+                    ).order_by(Parcel.id).limit(batch_size).with_for_update(
+                        skip_locked=True
+                    )
+                )).all()
+                if not claimed:
+                    await db_session.commit()
+                    return priced
+                ids = [row.id for row in claimed]
+                # only the claimed rows, skipped ones inside the id span
+                # belong to another worker
+                priced += await ParcelRepository.price_parcels(
+                    db_session,
+                    exchange_rate,
+                    [Parcel.id.in_(ids), Parcel.delivery_cost.is_(None)],
+                )
+                await db_session.commit()
+                last_id = ids[-1]
+                if on_chunk:
+                    await on_chunk(
+                        last_id, list({row.user_session_id for row in claimed})
+                    )
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            await db_session.rollback()
+            raise
+
+    @staticmethod
+    @timed_operation
+    async def calculate_delivery_costs_for_ids(
+            db_session: AsyncSession,
+            exchange_rate: float,
+            parcel_ids: list[int]
+    ) -> tuple[int, list[str]]:
+        """
+        calculate delivery cost of the given parcels that are not priced yet
+        :return: number of parcels priced and the user session ids owning
+            them
+        """
+        conditions = [
+            Parcel.id.in_(parcel_ids), Parcel.delivery_cost.is_(None)
+        ]
+        try:
+            session_ids = (await db_session.scalars(
+                select(Parcel.user_session_id).where(*conditions).distinct()
+            )).all()
+            priced = await ParcelRepository.price_parcels(
+                db_session, exchange_rate, conditions
             )
-            await db_session.execute(stmt)
             await db_session.commit()
+            return priced, session_ids
         except SQLAlchemyError as e:
             logger.error(f'An error occurred: {e}')
+            await db_session.rollback()
+            raise
 
     @staticmethod
+    @timed_operation
     async def assign_company(
             db_session: AsyncSession,
             company_id: int,
-            parcel_id
-    ):
+            parcel_id: int
+    ) -> bool:
+        """
+        the conditional update is atomic at the default isolation level,
+        it locks only the parcel row and the first writer wins
+        :return: False if the parcel is missing or already assigned
+        """
         try:
-            await db_session.execute(text(
-                'SET TRANSACTION ISOLATION LEVEL SERIALIZABLE')
-            )
             stmt = update(Parcel).where(
                 Parcel.id == parcel_id,
                 Parcel.delivery_company_id.is_(None)
@@ -143,38 +747,141 @@ class ParcelRepository:
                 delivery_company_id=company_id
             )
             res = await db_session.execute(stmt)
-            await db_session.commit()
+            if res.rowcount > 0:
+                await ParcelSummaryRepository.add_from_parcels(
+                    db_session,
+                    [Parcel.id == parcel_id],
+                    unassigned=-func.count(),
+                )
+            return res.rowcount > 0
+        except IntegrityError as e:
+            # company deleted after the existence check
+            raise CompanyNotFound(company_id) from e
+        except SQLAlchemyError as e:
+            logger.error(f'An error occurred: {e}')
+            raise
 
-            if res.rowcount == 0:
-                return False
-            else:
-                return True
-        except IntegrityError:
-            # todo: too wide
-            raise Exception()
+    @staticmethod
+    @timed_operation
+    async def assign_company_many(
+            db_session: AsyncSession,
+            company_id: int,
+            parcel_ids: list[int]
+    ) -> dict[int, EAssignResult]:
+        """
+        claim every still unassigned parcel of parcel_ids with one
+        conditional update
+        :return: result per requested parcel id
+        """
+        try:
+            # the first read fixes the snapshot of the transaction, the read
+            # back shows own changes on top of it, so parcels claimed by a
+            # concurrent transaction stay unassigned there
+            stmt = select(Parcel.id, Parcel.delivery_company_id).where(
+                Parcel.id.in_(parcel_ids)
+            )
+            before = dict((await db_session.execute(stmt)).all())
+            unassigned = [
+                parcel_id for parcel_id, assigned_id in before.items()
+                if assigned_id is None
+            ]
+            after = {}
+            if unassigned:
+                await db_session.execute(
+                    update(Parcel).where(
+                        Parcel.id.in_(unassigned),
+                        Parcel.delivery_company_id.is_(None)
+                    ).values(
+                        delivery_company_id=company_id
+                    ).execution_options(synchronize_session=False)
+                )
+                stmt = select(Parcel.id, Parcel.delivery_company_id).where(
+                    Parcel.id.in_(unassigned)
+                )
+                after = dict((await db_session.execute(stmt)).all())
+                won = [
+                    parcel_id for parcel_id, assigned_id in after.items()
+                    if assigned_id == company_id
+                ]
+                if won:
+                    await ParcelSummaryRepository.add_from_parcels(
+                        db_session,
+                        [Parcel.id.in_(won)],
+                        unassigned=-func.count(),
+                    )
+        except IntegrityError as e:
+            raise CompanyNotFound(company_id) from e
         except SQLAlchemyError as e:
             logger.error(f'An error occurred: {e}')
+            raise
+
+        results = {}
+        for parcel_id in parcel_ids:
+            if parcel_id not in before:
+                results[parcel_id] = EAssignResult.not_found
+            elif after.get(parcel_id) == company_id:
+                results[parcel_id] = EAssignResult.won
+            else:
+                results[parcel_id] = EAssignResult.lost
+        return results
+
+
+class CompanyRepository:
+    @staticmethod
+    @timed_operation
+    async def exists(db_session: AsyncSession, company_id: int) -> bool:
+        """
+        checked against the in-process company registry, unknown ids are
+        looked up in db in case the company was added since the last load
+        """
+        if company_registry.is_stale:
+            result = await db_session.scalars(select(Company.id))
+            company_registry.update(result.all())
+        if company_id in company_registry:
+            return True
+        found = await db_session.scalar(
+            select(Company.id).where(Company.id == company_id)
+        )
+        if found is None:
+            return False
+        company_registry.add(company_id)
+        return True
 
 
 class ParcelTypeRepository:
     @staticmethod
-    async def get_by_name(db_session: AsyncSession, parcel_type):
+    @timed_operation
+    async def refresh_registry(db_session: AsyncSession, force: bool = False):
+        """
+        reload parcel types registry from db if it is stale
+        """
+        if not force and not parcel_type_registry.is_stale:
+            return
+        async with parcel_type_registry.lock:
+            if not force and not parcel_type_registry.is_stale:
+                return
+            result = await db_session.execute(select(ParcelType))
+            parcel_type_registry.update(result.scalars().all())
+
+    @staticmethod
+    @timed_operation
+    async def get_by_name(
+            db_session: AsyncSession,
+            parcel_type: EParcelType
+    ) -> ParcelTypePD:
         try:
-            stmt = select(ParcelType).where(ParcelType.name == parcel_type.name)
-            result = await db_session.execute(stmt)
-            result = result.scalar_one_or_none()
-            return result
+            await ParcelTypeRepository.refresh_registry(db_session)
         except SQLAlchemyError as e:
             logger.error(f'An error occurred: {e}')
-            return None
+        return parcel_type_registry.get_by_name(parcel_type.name)
 
     @staticmethod
-    async def get_all(db_session: AsyncSession):
+    @timed_operation
+    async def get_all(db_session: AsyncSession) -> list[ParcelTypePD]:
         try:
-            stmt = select(ParcelType)
-            result = await db_session.execute(stmt)
-            result = result.scalars().all()
-            return result
+            await ParcelTypeRepository.refresh_registry(db_session)
         except SQLAlchemyError as e:
             logger.error(f'An error occurred: {e}')
-            return None
+            if parcel_type_registry.etag is None:
+                return None
+        return parcel_type_registry.all()
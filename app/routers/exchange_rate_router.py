@@ -0,0 +1,39 @@
+from typing import Optional
+
+from fastapi import APIRouter, status
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from app.exchange_rates import ExchangeRateUnavailable, exchange_rate_provider
+
+exchange_rate_router = APIRouter(
+    tags=['exchange rates'], prefix='/exchange-rates'
+)
+
+
+@exchange_rate_router.get(
+    '',
+    status_code=status.HTTP_200_OK,
+    description='Get rubles per currency unit, of all or of one currency'
+)
+async def get_exchange_rates(currency: Optional[str] = None):
+    try:
+        exchange_rates = await exchange_rate_provider.get_rates()
+    except ExchangeRateUnavailable:
+        return JSONResponse(
+            status_code=503,
+            content=jsonable_encoder('Exchange rates are unavailable'),
+        )
+    if currency is None:
+        return exchange_rates.model_dump()
+
+    rate = exchange_rates.rates.get(currency.upper())
+    if rate is None:
+        return JSONResponse(
+            status_code=404,
+            content=jsonable_encoder(f'Currency {currency} not found'),
+        )
+    return {
+        'timestamp': exchange_rates.timestamp,
+        'rates': {currency.upper(): rate},
+    }
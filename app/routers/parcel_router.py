@@ -1,26 +1,86 @@
-import asyncio
+import json
+from typing import Optional
 
-from fastapi import APIRouter, Depends, Query, Request, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
 from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
 from app import logger
-from app.db import database
-from app.pydantic_models.pydantic_models import (EParcelType,
-                                                 ParcelDetailResponse,
-                                                 ParcelPD)
-from app.repositories import (ParcelRepository, ParcelTypeRepository,
-                              UserRepository)
+from app.cache import parcel_cache
+from app.db import UnitOfWork, database, invalidate_written
+from app.delivery_costs import delivery_cost_batcher
+from app.exchange_rates import ExchangeRateUnavailable, exchange_rate_provider
+from app.pagination import decode_cursor, encode_cursor
+from app.pydantic_models.pydantic_models import (AssignCompanyBatchPD,
+                                                 EAssignResult, EExportFormat,
+                                                 EParcelType, ParcelPD)
+from app.registries import parcel_type_registry
+from app.repositories import (CompanyNotFound, CompanyRepository,
+                              ParcelRepository, ParcelSummaryRepository,
+                              ParcelTypeRepository, UserRepository)
+from app.serializers import ParcelSerializer
+from app.settings import settings
+from app.tariffs import tariff_engine
 
 parcel_router = APIRouter(tags=['parcel'], prefix='/parcel')
 
-loop = asyncio.get_event_loop()
+
+def pagination_params(
+    limit: int = 10,
+    skip_pages: int = 0,
+    cursor: Optional[str] = None,
+):
+    """
+    cursor returned in X-Next-Cursor takes precedence over skip_pages offset
+    """
+    after_id = None
+    if cursor:
+        after_id = decode_cursor(cursor)
+        if after_id is None:
+            raise HTTPException(status_code=422, detail='Invalid cursor')
+    return {'limit': limit, 'skip_pages': skip_pages, 'after_id': after_id}
 
 
-def pagination_params(limit: int = 10, skip_pages: int = 0):
-    return {'limit': limit, 'skip_pages': skip_pages}
+async def read_batch_payload(request: Request) -> list:
+    """
+    read batch body, either a JSON array or NDJSON (one parcel per line,
+    blank lines skipped)
+    :return: decoded items, NDJSON lines that don't decode are kept as
+        their ValueError, or None if a JSON array body is malformed
+    """
+    body = await request.body()
+    if request.headers.get('content-type', '').startswith(
+        'application/x-ndjson'
+    ):
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(e)
+        return items
+    try:
+        items = json.loads(body)
+    except ValueError:
+        return None
+    return items if isinstance(items, list) else None
+
+
+async def invalidate_parcel_owners(
+    uow: UnitOfWork,
+    parcel_repo: ParcelRepository,
+    parcel_ids: list[int],
+):
+    """
+    drop cached responses of the users owning the updated parcels
+    """
+    session_ids = await parcel_repo.get_session_ids(uow.session, parcel_ids)
+    await invalidate_written(*session_ids)
 
 
 @parcel_router.post(
@@ -29,22 +89,23 @@ def pagination_params(limit: int = 10, skip_pages: int = 0):
 async def register_parcel(
     request: Request,
     parcel_filter: ParcelPD,
-    db_session: AsyncSession = Depends(database.scoped_session_dependency),
+    uow: UnitOfWork = Depends(database.unit_of_work_dependency),
     user_repo: UserRepository = Depends(),
     parcel_type_repo: ParcelTypeRepository = Depends(),
     parcel_repo: ParcelRepository = Depends(),
 ):
-    logger.info(request.state)
-    session_id = request.cookies.get('session_id')
+    session_id = request.state.session_id
     try:
-        user = await user_repo.get_or_create(db_session, session_id)
+        # user upsert is committed together with the parcel
+        await user_repo.upsert(uow.session, session_id)
         parcel_type = await parcel_type_repo.get_by_name(
-            db_session, parcel_filter.parcel_type
+            uow.session, parcel_filter.parcel_type
         )
         if parcel_type:
             created_parcel = await parcel_repo.create(
-                db_session, parcel_filter, parcel_type, user.session_id
+                uow.session, parcel_filter, parcel_type, session_id
             )
+            await uow.commit()
         else:
             return JSONResponse(
                 status_code=404,
@@ -56,22 +117,155 @@ async def register_parcel(
         logger.info(e)
         return JSONResponse(status_code=500, content=jsonable_encoder(e))
 
+    delivery_cost_batcher.add([created_parcel.id])
+    await invalidate_written(session_id)
     return JSONResponse(
         status_code=200, content=jsonable_encoder(created_parcel.id)
     )
 
 
+@parcel_router.post(
+    '/register/batch',
+    status_code=status.HTTP_200_OK,
+    description='Register parcels in bulk from a JSON array or NDJSON body'
+)
+async def register_parcels_batch(
+    request: Request,
+    uow: UnitOfWork = Depends(database.unit_of_work_dependency),
+    user_repo: UserRepository = Depends(),
+    parcel_type_repo: ParcelTypeRepository = Depends(),
+    parcel_repo: ParcelRepository = Depends(),
+):
+    items = await read_batch_payload(request)
+    if items is None:
+        return JSONResponse(
+            status_code=422,
+            content=jsonable_encoder(
+                'Expected a JSON array or NDJSON of parcels'
+            ),
+        )
+    if len(items) > settings.PARCEL_BATCH_MAX_SIZE:
+        return JSONResponse(
+            status_code=413,
+            content=jsonable_encoder(
+                f'Batch is limited to {settings.PARCEL_BATCH_MAX_SIZE} parcels'
+            ),
+        )
+
+    session_id = request.state.session_id
+    try:
+        await user_repo.upsert(uow.session, session_id)
+        parcel_type_ids = {
+            parcel_type.name: parcel_type.id
+            for parcel_type in await parcel_type_repo.get_all(uow.session) or []
+        }
+
+        valid, positions, errors = [], [], []
+        for index, item in enumerate(items):
+            if isinstance(item, ValueError):
+                errors.append({
+                    'index': index,
+                    'detail': f'Invalid JSON: {item}',
+                })
+                continue
+            try:
+                parcel = ParcelPD.model_validate(item)
+            except ValidationError as e:
+                errors.append({
+                    'index': index,
+                    'detail': e.errors(
+                        include_url=False, include_context=False
+                    ),
+                })
+                continue
+            parcel_type_id = parcel_type_ids.get(parcel.parcel_type.name)
+            if parcel_type_id is None:
+                errors.append({
+                    'index': index,
+                    'detail': f'Parcel type {parcel.parcel_type} not found',
+                })
+                continue
+            valid.append((parcel, parcel_type_id))
+            positions.append(index)
+
+        created_ids = await parcel_repo.create_many(
+            uow.session, valid, session_id
+        ) if valid else []
+        await uow.commit()
+    except SQLAlchemyError as e:
+        logger.info(e)
+        return JSONResponse(status_code=500, content=jsonable_encoder(e))
+
+    if created_ids:
+        delivery_cost_batcher.add(created_ids)
+        await invalidate_written(session_id)
+    ids = [None] * len(items)
+    for index, parcel_id in zip(positions, created_ids):
+        ids[index] = parcel_id
+    return JSONResponse(
+        status_code=200,
+        content=jsonable_encoder({'ids': ids, 'errors': errors}),
+    )
+
+
+@parcel_router.post(
+    '/quote',
+    status_code=status.HTTP_200_OK,
+    description='Get delivery cost of a parcel without registering it'
+)
+async def quote_parcel(
+    parcel: ParcelPD,
+    company_id: Optional[int] = None,
+    db_session: AsyncSession = Depends(database.read_session_dependency),
+    parcel_type_repo: ParcelTypeRepository = Depends(),
+):
+    parcel_type = await parcel_type_repo.get_by_name(
+        db_session, parcel.parcel_type
+    )
+    if not parcel_type:
+        return JSONResponse(
+            status_code=404,
+            content=jsonable_encoder(
+                f'Parcel type {parcel.parcel_type} not found'
+            ),
+        )
+    try:
+        exchange_rate = await exchange_rate_provider.get_rate()
+    except ExchangeRateUnavailable:
+        return JSONResponse(
+            status_code=503,
+            content=jsonable_encoder('Exchange rates are unavailable'),
+        )
+    delivery_cost = tariff_engine.quote(
+        parcel_type.id,
+        parcel.weight,
+        parcel.content_cost,
+        company_id,
+        exchange_rate,
+    )
+    return JSONResponse(
+        status_code=200,
+        content=jsonable_encoder({'delivery_cost': delivery_cost}),
+    )
+
+
 @parcel_router.get(
     '/parcel-types',
     status_code=status.HTTP_200_OK,
     description='Get parcel types'
 )
 async def get_parcel_types(
-    db_session: AsyncSession = Depends(database.scoped_session_dependency),
+    request: Request,
+    db_session: AsyncSession = Depends(database.read_session_dependency),
     parcel_repo: ParcelTypeRepository = Depends(),
 ):
     parcels = await parcel_repo.get_all(db_session)
-    return JSONResponse(status_code=200, content=jsonable_encoder(parcels))
+    headers = {'ETag': parcel_type_registry.etag} if parcels is not None else {}
+    if headers and request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(
+        status_code=200, content=jsonable_encoder(parcels), headers=headers
+    )
 
 
 @parcel_router.get(
@@ -82,37 +276,109 @@ async def get_parcel_types(
 async def get_user_parcels(
     request: Request,
     pagination: dict = Depends(pagination_params),
-    db_session: AsyncSession = Depends(database.scoped_session_dependency),
+    db_session: AsyncSession = Depends(database.read_session_dependency),
     parcel_repo: ParcelRepository = Depends(),
     parcel_type: EParcelType = Query(None, alias='parcel_type'),
     has_delivery_cost: bool = Query(None, alias='has_delivery_cost'),
 ):
-    session_id = request.cookies.get('session_id')
-    parcels_res = await parcel_repo.get_all_by_session_id(
-        db_session, session_id, pagination, has_delivery_cost, parcel_type
+    session_id = request.state.session_id
+    cache_params = {
+        **pagination,
+        'parcel_type': parcel_type.value if parcel_type else None,
+        'has_delivery_cost': has_delivery_cost,
+    }
+
+    async def build() -> Response:
+        parcels_res = await parcel_repo.get_all_by_session_id(
+            db_session, session_id, pagination, has_delivery_cost, parcel_type
+        )
+        headers = {}
+        if len(parcels_res) == pagination['limit']:
+            headers['X-Next-Cursor'] = encode_cursor(parcels_res[-1][0].id)
+        return Response(
+            content=ParcelSerializer.dump_many(parcels_res),
+            status_code=200,
+            media_type='application/json',
+            headers=headers,
+        )
+
+    return await parcel_cache.get_or_build(
+        session_id, 'user-parcels', cache_params, build
     )
 
-    serialized_parcels = [
-        ParcelDetailResponse(
-            id=parcel.id,
-            name=parcel.name,
-            weight=parcel.weight,
-            parcel_type=parcel_type.name,
-            content_value=parcel.content_value,
-            delivery_cost=parcel.delivery_cost
-            if parcel.delivery_cost
-            else 'No info yet.',
-            delivery_company_id=parcel.delivery_company_id
-            if parcel.delivery_company_id
-            else 'Not assigned yet.',
-        )
-        for parcel, parcel_type in parcels_res
-    ]
-    return JSONResponse(
-        status_code=200, content=jsonable_encoder(serialized_parcels)
+
+@parcel_router.get(
+    '/search',
+    status_code=status.HTTP_200_OK,
+    description='Search user parcels by name fragment, weight and content '
+                'value ranges'
+)
+async def search_user_parcels(
+    request: Request,
+    pagination: dict = Depends(pagination_params),
+    db_session: AsyncSession = Depends(database.read_session_dependency),
+    parcel_repo: ParcelRepository = Depends(),
+    name: Optional[str] = Query(None, min_length=1, max_length=255),
+    min_weight: Optional[float] = Query(None),
+    max_weight: Optional[float] = Query(None),
+    min_content_value: Optional[float] = Query(None),
+    max_content_value: Optional[float] = Query(None),
+):
+    session_id = request.state.session_id
+    filters = {
+        'name': name,
+        'min_weight': min_weight,
+        'max_weight': max_weight,
+        'min_content_value': min_content_value,
+        'max_content_value': max_content_value,
+    }
+
+    async def build() -> Response:
+        parcels_res = await parcel_repo.search_by_session_id(
+            db_session, session_id, pagination, **filters
+        )
+        headers = {}
+        if len(parcels_res) == pagination['limit']:
+            headers['X-Next-Cursor'] = encode_cursor(parcels_res[-1][0].id)
+        return Response(
+            content=ParcelSerializer.dump_many(parcels_res),
+            status_code=200,
+            media_type='application/json',
+            headers=headers,
+        )
+
+    return await parcel_cache.get_or_build(
+        session_id, 'search', {**pagination, **filters}, build
     )
 
 
+@parcel_router.get(
+    '/summary',
+    status_code=status.HTTP_200_OK,
+    description='Get parcel count, content value and delivery cost totals '
+                'of the user, overall and per parcel type'
+)
+async def get_user_parcels_summary(
+    request: Request,
+    db_session: AsyncSession = Depends(database.read_session_dependency),
+    summary_repo: ParcelSummaryRepository = Depends(),
+):
+    session_id = request.state.session_id
+
+    async def build() -> Response:
+        try:
+            rows = await summary_repo.get_by_session_id(db_session, session_id)
+        except SQLAlchemyError as e:
+            return JSONResponse(status_code=500, content=jsonable_encoder(e))
+        return Response(
+            content=ParcelSerializer.dump_summary(rows),
+            status_code=200,
+            media_type='application/json',
+        )
+
+    return await parcel_cache.get_or_build(session_id, 'summary', {}, build)
+
+
 @parcel_router.get(
     '/parcel-by-id',
     status_code=status.HTTP_200_OK,
@@ -121,33 +387,71 @@ async def get_user_parcels(
 async def get_user_parcel_by_id(
     request: Request,
     parcel_id: int,
-    db_session: AsyncSession = Depends(database.scoped_session_dependency),
+    db_session: AsyncSession = Depends(database.read_session_dependency),
     parcel_repo: ParcelRepository = Depends(),
 ):
-    session_id = request.cookies.get('session_id')
-    parcel_res = await parcel_repo.get_full_info_by_id(
-        db_session, session_id, parcel_id
+    session_id = request.state.session_id
+
+    async def build() -> Response:
+        parcel_res = await parcel_repo.get_full_info_by_id(
+            db_session, session_id, parcel_id
+        )
+        if parcel_res:
+            return Response(
+                content=ParcelSerializer.dump_one(parcel_res),
+                status_code=200,
+                media_type='application/json',
+            )
+        else:
+            return JSONResponse(
+                status_code=404,
+                content=jsonable_encoder(
+                    f'Parcel with id {parcel_id} not found'
+                ),
+            )
+
+    return await parcel_cache.get_or_build(
+        session_id, 'parcel-by-id', {'parcel_id': parcel_id}, build
     )
-    if parcel_res:
-        parcel, parcel_type = parcel_res
-        return ParcelDetailResponse(
-            id=None,
-            name=parcel.name,
-            weight=parcel.weight,
-            parcel_type=parcel_type.name,
-            content_value=parcel.content_value,
-            delivery_cost=parcel.delivery_cost
-            if parcel.delivery_cost
-            else 'No info yet.',
-            delivery_company_id=parcel.delivery_company_id
-            if parcel.delivery_company_id
-            else 'Not assigned yet.',
-        ).model_dump(exclude_none=True)
+
+
+@parcel_router.get(
+    '/export',
+    status_code=status.HTTP_200_OK,
+    description='Stream all user parcels as NDJSON or CSV'
+)
+async def export_user_parcels(
+    request: Request,
+    export_format: EExportFormat = Query(
+        EExportFormat.ndjson, alias='format'
+    ),
+    parcel_repo: ParcelRepository = Depends(),
+):
+    session_id = request.state.session_id
+
+    async def partitions():
+        # the body is iterated in its own task, so the stream owns a session
+        # instead of using the task scoped one of the request
+        async with await database.read_session(session_id) as db_session:
+            async for rows in parcel_repo.stream_by_session_id(
+                db_session, session_id
+            ):
+                yield rows
+
+    if export_format == EExportFormat.csv:
+        body, media_type = ParcelSerializer.iter_csv(partitions()), 'text/csv'
     else:
-        return JSONResponse(
-            status_code=404,
-            content=jsonable_encoder(f'Parcel with id {parcel_id} not found'),
+        body, media_type = (
+            ParcelSerializer.iter_ndjson(partitions()), 'application/x-ndjson'
         )
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={
+            'Content-Disposition':
+                f'attachment; filename=parcels.{export_format.value}'
+        },
+    )
 
 
 @parcel_router.put(
@@ -157,25 +461,79 @@ async def get_user_parcel_by_id(
 )
 async def assign_delivery_company(
     parcel_id: int,
-    company_id,
-    db_session: AsyncSession = Depends(database.scoped_session_dependency),
+    company_id: int,
+    uow: UnitOfWork = Depends(database.unit_of_work_dependency),
     parcel_repo: ParcelRepository = Depends(),
+    company_repo: CompanyRepository = Depends(),
 ):
-
     try:
+        if not await company_repo.exists(uow.session, company_id):
+            raise CompanyNotFound(company_id)
         update_res = await parcel_repo.assign_company(
-            db_session, company_id, parcel_id
+            uow.session, company_id, parcel_id
         )
-        if update_res:
-            return JSONResponse(status_code=200, content=jsonable_encoder('OK'))
-        else:
-            return JSONResponse(
-                status_code=409, content=jsonable_encoder('Conflict')
-            )
-
-    # todo: too wide
-    except Exception:
+        await uow.commit()
+    except CompanyNotFound:
         return JSONResponse(
             status_code=404,
             content=jsonable_encoder(f'Company with id {company_id} not found'),
         )
+    except SQLAlchemyError as e:
+        logger.info(e)
+        return JSONResponse(status_code=500, content=jsonable_encoder(e))
+
+    if not update_res:
+        return JSONResponse(
+            status_code=409, content=jsonable_encoder('Conflict')
+        )
+    await invalidate_parcel_owners(uow, parcel_repo, [parcel_id])
+    return JSONResponse(status_code=200, content=jsonable_encoder('OK'))
+
+
+@parcel_router.put(
+    '/assign-company/batch',
+    status_code=status.HTTP_200_OK,
+    description='Assign delivery company to many parcels, first claim wins',
+)
+async def assign_delivery_company_batch(
+    payload: AssignCompanyBatchPD,
+    uow: UnitOfWork = Depends(database.unit_of_work_dependency),
+    parcel_repo: ParcelRepository = Depends(),
+    company_repo: CompanyRepository = Depends(),
+):
+    parcel_ids = list(dict.fromkeys(payload.parcel_ids))
+    if len(parcel_ids) > settings.PARCEL_BATCH_MAX_SIZE:
+        return JSONResponse(
+            status_code=413,
+            content=jsonable_encoder(
+                f'Batch is limited to {settings.PARCEL_BATCH_MAX_SIZE} parcels'
+            ),
+        )
+    try:
+        if not await company_repo.exists(uow.session, payload.company_id):
+            raise CompanyNotFound(payload.company_id)
+        results = await parcel_repo.assign_company_many(
+            uow.session, payload.company_id, parcel_ids
+        ) if parcel_ids else {}
+        await uow.commit()
+    except CompanyNotFound:
+        return JSONResponse(
+            status_code=404,
+            content=jsonable_encoder(
+                f'Company with id {payload.company_id} not found'
+            ),
+        )
+    except SQLAlchemyError as e:
+        logger.info(e)
+        return JSONResponse(status_code=500, content=jsonable_encoder(e))
+
+    won = [
+        parcel_id for parcel_id, result in results.items()
+        if result == EAssignResult.won
+    ]
+    if won:
+        await invalidate_parcel_owners(uow, parcel_repo, won)
+    return JSONResponse(
+        status_code=200,
+        content=jsonable_encoder({'results': results}),
+    )
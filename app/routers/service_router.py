@@ -0,0 +1,27 @@
+from fastapi import APIRouter, status
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.responses import Response
+
+from app.db import database, pool_collector
+from app.metrics import metrics_registry
+
+service_router = APIRouter(tags=['service'], prefix='/service')
+# served at the root for scrapers, outside of ROOT_PATH
+metrics_router = APIRouter(tags=['service'])
+
+
+@service_router.get(
+    '/db-pool',
+    status_code=status.HTTP_200_OK,
+    description='Connection pool usage of this worker process'
+)
+async def get_db_pool_stats():
+    return database.pool_stats()
+
+
+@metrics_router.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    return Response(
+        content=generate_latest(metrics_registry(pool_collector)),
+        media_type=CONTENT_TYPE_LATEST,
+    )
@@ -0,0 +1,111 @@
+import csv
+import io
+from typing import AsyncIterator, Iterable
+
+import orjson
+
+from app.models import SUMMARY_COUNTERS, Parcel, ParcelType
+
+NO_DELIVERY_COST = 'No info yet.'
+NO_DELIVERY_COMPANY = 'Not assigned yet.'
+
+CSV_FIELDS = (
+    'id', 'name', 'weight', 'parcel_type', 'content_value',
+    'delivery_cost', 'delivery_company_id',
+)
+
+
+def parcel_to_dict(parcel: Parcel, parcel_type: ParcelType) -> dict:
+    """
+    field mapping of ParcelDetailResponse, kept as a single dict literal
+    so a row costs one function call
+    """
+    return {
+        'id': parcel.id,
+        'name': parcel.name,
+        'weight': parcel.weight,
+        'parcel_type': parcel_type.name,
+        'content_value': parcel.content_value,
+        'delivery_cost': parcel.delivery_cost or NO_DELIVERY_COST,
+        # ParcelDetailResponse types the company id as float
+        'delivery_company_id': float(parcel.delivery_company_id)
+        if parcel.delivery_company_id
+        else NO_DELIVERY_COMPANY,
+    }
+
+
+def summary_to_dict(rows: Iterable) -> dict:
+    """
+    totals over every parcel type plus the totals of each type
+    :param rows: (ParcelSummary, ParcelType) rows of one user
+    """
+    summary = dict.fromkeys(SUMMARY_COUNTERS, 0)
+    by_type = {}
+    for parcel_summary, parcel_type in rows:
+        totals = {
+            name: getattr(parcel_summary, name) for name in SUMMARY_COUNTERS
+        }
+        for name, value in totals.items():
+            summary[name] += value
+        by_type[parcel_type.name] = totals
+    summary['by_type'] = by_type
+    return summary
+
+
+class ParcelSerializer:
+    """
+    Encodes (Parcel, ParcelType) rows straight to JSON bytes, producing the
+    same documents as ParcelDetailResponse without building pydantic models
+    and running jsonable_encoder over them.
+    """
+
+    @staticmethod
+    def dump_many(rows: Iterable) -> bytes:
+        return orjson.dumps([
+            parcel_to_dict(parcel, parcel_type)
+            for parcel, parcel_type in rows
+        ])
+
+    @staticmethod
+    def dump_summary(rows: Iterable) -> bytes:
+        return orjson.dumps(summary_to_dict(rows))
+
+    @staticmethod
+    def dump_one(row, include_id: bool = False) -> bytes:
+        parcel, parcel_type = row
+        serialized = parcel_to_dict(parcel, parcel_type)
+        if not include_id:
+            del serialized['id']
+        return orjson.dumps(serialized)
+
+    @staticmethod
+    async def iter_ndjson(partitions: AsyncIterator[list]) -> AsyncIterator:
+        """
+        encode streamed row partitions as NDJSON, one chunk per partition
+        """
+        async for rows in partitions:
+            yield b''.join(
+                orjson.dumps(
+                    parcel_to_dict(parcel, parcel_type),
+                    option=orjson.OPT_APPEND_NEWLINE,
+                )
+                for parcel, parcel_type in rows
+            )
+
+    @staticmethod
+    async def iter_csv(partitions: AsyncIterator[list]) -> AsyncIterator:
+        """
+        encode streamed row partitions as CSV with a header line
+        """
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        yield buffer.getvalue()
+        async for rows in partitions:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(
+                parcel_to_dict(parcel, parcel_type)
+                for parcel, parcel_type in rows
+            )
+            yield buffer.getvalue()
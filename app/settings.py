@@ -1,8 +1,10 @@
 import os
 
-from pydantic import Field
+from pydantic import Field, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from app.pydantic_models.pydantic_models import TariffRulePD
+
 
 class AppSettings(BaseSettings):
     model_config = SettingsConfigDict(
@@ -22,6 +24,15 @@ class DBConfig(AppSettings):
     password: str = Field('PASS')
     name: str = Field('NAME')
     echo: bool = Field('ECHO')
+    # per process, size against max_connections divided by the number of
+    # uvicorn and celery worker processes
+    pool_size: int = 10
+    max_overflow: int = 10
+    # seconds to wait for a free connection before failing the request
+    pool_timeout: float = 10
+    # reconnect before MySQL wait_timeout closes idle connections
+    pool_recycle: int = 1800
+    pool_pre_ping: bool = True
     model_config = SettingsConfigDict(env_prefix='DB_')
 
     def generate_db_url(
@@ -37,6 +48,8 @@ class DBConfig(AppSettings):
 class CelerySettings(AppSettings):
     CELERY_BROKER_URL: str = Field('CELERY_BROKER_URL')
     CELERY_RESULT_BACKEND: str = Field('CELERY_RESULT_BACKEND')
+    # prometheus exporter of the worker, 0 disables it
+    CELERY_METRICS_PORT: int = 9808
 
 
 class Settings(AppSettings):
@@ -44,11 +57,63 @@ class Settings(AppSettings):
     # DB
     DB: DBConfig = DBConfig()
     DB_URL: str = DB.generate_db_url()
+    # read only traffic is spread over these, JSON list of database urls
+    DB_REPLICA_URLS: list[str] = []
+    # seconds a failed replica is left out of the rotation
+    DB_REPLICA_RETRY_SECONDS: int = 30
+    # seconds a session reads from the primary after it writes, 0 disables.
+    # Required with replicas and the parcel cache both on, longer than the
+    # replication lag: a response rebuilt from a replica missing the write
+    # right after it invalidated the cache would be cached for its ttl
+    DB_READ_YOUR_WRITES_SECONDS: int = 0
+
+    # batch parcel registration
+    PARCEL_BATCH_MAX_SIZE: int = 10000
+    PARCEL_BATCH_INSERT_SIZE: int = 1000
+
+    # seconds before the in-process parcel types registry is reloaded
+    PARCEL_TYPES_TTL_SECONDS: int = 300
+
+    # seconds before the in-process set of company ids is reloaded
+    COMPANIES_TTL_SECONDS: int = 300
+
+    # parcels priced per committed chunk of the delivery cost job
+    DELIVERY_COST_BATCH_SIZE: int = 1000
+    # JSON list of delivery cost rules, the first matching one applies and
+    # parcels no rule matches are priced by the default formula
+    TARIFF_RULES: list[TariffRulePD] = []
+    # new parcel ids are sent to the delivery cost task at most this often
+    DELIVERY_COST_PUBLISH_INTERVAL_MS: int = 200
+    # the sweep only prices parcels the per-parcel task missed
+    DELIVERY_COST_SWEEP_INTERVAL_MINUTES: int = 10
+    # unpriced parcels per task the sweep is fanned out into,
+    # 0 runs the whole sweep in one task
+    DELIVERY_COST_SHARD_SIZE: int = 50000
+    # users recounted per transaction by a full parcel summary rebuild
+    PARCEL_SUMMARY_REBUILD_BATCH_SIZE: int = 500
+
+    # seconds parcel read responses are kept in the redis cache, 0 disables
+    PARCEL_CACHE_TTL_SECONDS: int = 60
+
+    # rows fetched per server side cursor round trip by parcel export
+    PARCEL_EXPORT_YIELD_PER: int = 1000
+
+    # token bucket per session for the parcel endpoints
+    RATE_LIMIT_CAPACITY: int = 50
+    RATE_LIMIT_REFILL_PER_SECOND: float = 10
+
+    # session ids of existing users remembered in process
+    KNOWN_SESSIONS_CACHE_SIZE: int = 100000
 
     CBR_API_URL: str = Field('CBR_API_URL')
     EXCHANGE_RATE_UPDATE_INTERVAL_MINUTES: int = (
         Field('EXCHANGE_RATE_UPDATE_INTERVAL_MINUTES')
     )
+    EXCHANGE_RATE_FETCH_TIMEOUT_SECONDS: float = 5
+    # in-process copy of the redis cached rate
+    EXCHANGE_RATE_LOCAL_TTL_SECONDS: int = 60
+    # how long an expired rate may be served while it can't be refreshed
+    EXCHANGE_RATE_STALE_GRACE_SECONDS: int = 600
 
     # Redis
     REDIS_HOST: str = Field('REDIS_HOST')
@@ -56,5 +121,18 @@ class Settings(AppSettings):
     CELERY: CelerySettings = CelerySettings()
     DEBUG_MODE: bool = Field('DEBUG_MODE')
 
+    @model_validator(mode='after')
+    def check_read_your_writes(self) -> 'Settings':
+        if (
+            self.DB_REPLICA_URLS
+            and self.PARCEL_CACHE_TTL_SECONDS
+            and not self.DB_READ_YOUR_WRITES_SECONDS
+        ):
+            raise ValueError(
+                'DB_READ_YOUR_WRITES_SECONDS is required when both '
+                'DB_REPLICA_URLS and PARCEL_CACHE_TTL_SECONDS are set'
+            )
+        return self
+
 
 settings = Settings()
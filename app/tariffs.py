@@ -0,0 +1,168 @@
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import and_, case, false, true
+
+from app.models import Parcel
+from app.pydantic_models.pydantic_models import TariffRulePD
+from app.registries import parcel_type_registry
+from app.settings import settings
+
+# delivery company id of unassigned parcels in the price arrays
+NO_COMPANY = 0
+
+# the original formula, prices every parcel no configured rule matches
+DEFAULT_RULE = TariffRulePD(per_kg=0.5, content_rate=0.01)
+
+
+class TariffEngine:
+    """
+    Delivery cost by the first matching rule of an ordered list, ending
+    with the catch-all DEFAULT_RULE.
+
+    A batch is priced in one vectorized pass over numpy arrays. When no
+    rule uses a weight step table the rules also compile to a single SQL
+    CASE expression, so stored parcels are priced by the database without
+    being fetched.
+    """
+
+    def __init__(self, rules: list[TariffRulePD]):
+        self.rules = [*rules, DEFAULT_RULE]
+        self._base = np.array([rule.base for rule in self.rules])
+        self._per_kg = np.array([rule.per_kg for rule in self.rules])
+        self._content_rate = np.array(
+            [rule.content_rate for rule in self.rules]
+        )
+
+    @property
+    def pushdown(self) -> bool:
+        return all(rule.weight_steps is None for rule in self.rules)
+
+    @staticmethod
+    def _parcel_type_id(rule: TariffRulePD) -> Optional[int]:
+        parcel_type = parcel_type_registry.get_by_name(rule.parcel_type.value)
+        return parcel_type.id if parcel_type else None
+
+    def match(
+            self,
+            parcel_type_ids: np.ndarray,
+            weights: np.ndarray,
+            company_ids: np.ndarray
+    ) -> np.ndarray:
+        """
+        :return: index of the applied rule per parcel
+        """
+        rule_index = np.full(len(weights), len(self.rules) - 1)
+        unmatched = np.ones(len(weights), dtype=bool)
+        for index, rule in enumerate(self.rules[:-1]):
+            mask = unmatched.copy()
+            if rule.parcel_type is not None:
+                parcel_type_id = self._parcel_type_id(rule)
+                if parcel_type_id is None:
+                    continue
+                mask &= parcel_type_ids == parcel_type_id
+            if rule.company_id is not None:
+                mask &= company_ids == rule.company_id
+            if rule.min_weight:
+                mask &= weights >= rule.min_weight
+            if rule.max_weight is not None:
+                mask &= weights < rule.max_weight
+            rule_index[mask] = index
+            unmatched &= ~mask
+        return rule_index
+
+    @staticmethod
+    def _step_price(rule: TariffRulePD, weights: np.ndarray) -> np.ndarray:
+        limits = np.array([weight for weight, _ in rule.weight_steps])
+        prices = np.array([price for _, price in rule.weight_steps])
+        step = np.minimum(np.searchsorted(limits, weights), len(limits) - 1)
+        overweight = np.maximum(weights - limits[-1], 0)
+        return prices[step] + overweight * rule.per_kg
+
+    def price(
+            self,
+            parcel_type_ids: np.ndarray,
+            weights: np.ndarray,
+            content_values: np.ndarray,
+            company_ids: np.ndarray,
+            exchange_rate: float
+    ) -> np.ndarray:
+        """
+        :param company_ids: NO_COMPANY for unassigned parcels
+        :return: delivery cost per parcel
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        content_values = np.asarray(content_values, dtype=np.float64)
+        rule_index = self.match(
+            np.asarray(parcel_type_ids), weights, np.asarray(company_ids)
+        )
+        weight_price = weights * self._per_kg[rule_index]
+        for index, rule in enumerate(self.rules):
+            if rule.weight_steps is not None:
+                selected = rule_index == index
+                weight_price[selected] = self._step_price(
+                    rule, weights[selected]
+                )
+        # same evaluation order as the SQL expression
+        return (
+            self._base[rule_index]
+            + (weight_price + content_values * self._content_rate[rule_index])
+        ) * exchange_rate
+
+    def quote(
+            self,
+            parcel_type_id: int,
+            weight: float,
+            content_value: float,
+            company_id: Optional[int],
+            exchange_rate: float
+    ) -> float:
+        return float(self.price(
+            np.array([parcel_type_id]),
+            np.array([weight]),
+            np.array([content_value]),
+            np.array([company_id or NO_COMPANY]),
+            exchange_rate,
+        )[0])
+
+    def _sql_condition(self, rule: TariffRulePD):
+        conditions = []
+        if rule.parcel_type is not None:
+            parcel_type_id = self._parcel_type_id(rule)
+            if parcel_type_id is None:
+                return false()
+            conditions.append(Parcel.parcel_type_id == parcel_type_id)
+        if rule.company_id is not None:
+            conditions.append(Parcel.delivery_company_id == rule.company_id)
+        if rule.min_weight:
+            conditions.append(Parcel.weight >= rule.min_weight)
+        if rule.max_weight is not None:
+            conditions.append(Parcel.weight < rule.max_weight)
+        return and_(true(), *conditions)
+
+    @staticmethod
+    def _sql_price(rule: TariffRulePD):
+        price = (
+            Parcel.weight * rule.per_kg
+            + Parcel.content_value * rule.content_rate
+        )
+        return rule.base + price if rule.base else price
+
+    def sql_clause(self, exchange_rate: float):
+        """
+        :return: delivery cost expression over parcel columns, None when a
+            rule can only be priced in python
+        """
+        if not self.pushdown:
+            return None
+        whens = [
+            (self._sql_condition(rule), self._sql_price(rule))
+            for rule in self.rules[:-1]
+        ]
+        price = self._sql_price(self.rules[-1])
+        if whens:
+            price = case(*whens, else_=price)
+        return price * exchange_rate
+
+
+tariff_engine = TariffEngine(settings.TARIFF_RULES)
@@ -0,0 +1,520 @@
+"""
+Load test of the parcel API and the delivery cost job.
+
+Runs the FastAPI app in process over httpx (no network), on SQLite through
+aiosqlite in place of MySQL and fakeredis in place of redis, so it needs
+no running services. Every scenario reports throughput and p50/p95/p99
+latency, the delivery cost job reports rows per second and per chunk
+latency for each table size. Batch registration is compared with calling
+the single endpoint in a loop for the same parcels, in rows per second.
+
+Results are compared with the JSON baseline, a scenario losing more than
+the tolerance of its throughput or p95/p99 latency, or failing more
+requests than before, is flagged and the run exits with status 1.
+Without a baseline file the results are saved as the new one.
+
+    python -m benchmarks.api [--rows 10000 100000 1000000]
+        [--requests 2000] [--concurrency 20] [--batch-size 1000]
+        [--baseline FILE]
+        [--update-baseline] [--tolerance 0.2] [--db-url URL]
+
+--db-url runs against another database (e.g. a local MySQL), its tables
+are dropped and recreated.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+
+import fakeredis
+import httpx
+import redis
+from fakeredis import aioredis as fake_aioredis
+
+DEFAULT_BASELINE = Path(__file__).with_name('api_baseline.json')
+EXCHANGE_RATE = 90.0
+DEEP_SESSION = 'bench-deep'
+PAGE_SIZE = 20
+
+
+def configure(db_url: str) -> None:
+    """
+    point the app at the benchmark database and fakeredis, has to run
+    before anything from app is imported
+    """
+    os.environ['DB_URL'] = db_url
+    # reads hit the database unless a scenario enables the cache
+    os.environ['PARCEL_CACHE_TTL_SECONDS'] = '0'
+    os.environ['RATE_LIMIT_CAPACITY'] = str(10 ** 9)
+    server = fakeredis.FakeServer()
+    redis.asyncio.Redis = partial(fake_aioredis.FakeRedis, server=server)
+    redis.StrictRedis = partial(fakeredis.FakeStrictRedis, server=server)
+
+
+def summarize(latencies: list[float], elapsed: float, errors: int) -> dict:
+    """
+    :param latencies: seconds per request
+    :param elapsed: wall time of the scenario in seconds
+    """
+    percentiles = (
+        statistics.quantiles(latencies, n=100)
+        if len(latencies) > 1 else latencies * 99
+    )
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentiles[49] * 1000, 3),
+        'p95_ms': round(percentiles[94] * 1000, 3),
+        'p99_ms': round(percentiles[98] * 1000, 3),
+    }
+
+
+async def run_requests(
+        calls: list, concurrency: int, expected=(200,)
+) -> tuple[dict, list]:
+    """
+    :param calls: coroutine functions sending one request each
+    :return: summary and the responses in completion order
+    """
+    pending = iter(calls)
+    latencies, responses = [], []
+
+    async def worker():
+        for call in pending:
+            started = time.perf_counter()
+            response = await call()
+            latencies.append(time.perf_counter() - started)
+            responses.append(response)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    errors = sum(
+        response.status_code not in expected for response in responses
+    )
+    return (
+        summarize(latencies, time.perf_counter() - started, errors),
+        responses,
+    )
+
+
+class Bench:
+
+    def __init__(self, client: httpx.AsyncClient, args):
+        from app.settings import settings
+
+        self.client = client
+        self.args = args
+        self.prefix = f'{settings.ROOT_PATH}/parcel'
+        self.random = random.Random(42)
+        self.results = {}
+
+    def request(self, method: str, path: str, session_id: str, **kwargs):
+        return partial(
+            self.client.request,
+            method,
+            f'{self.prefix}{path}',
+            headers={'cookie': f'session_id={session_id}'},
+            **kwargs,
+        )
+
+    def record(self, name: str, result: dict) -> None:
+        self.results[name] = result
+        sys.stdout.write(
+            f'{name:<32} {result["requests"]:>8} {result["errors"]:>6}'
+            f' {result["throughput"]:>10.1f} {result["p50_ms"]:>9.2f}'
+            f' {result["p95_ms"]:>9.2f} {result["p99_ms"]:>9.2f}\n'
+        )
+
+    async def register(self) -> None:
+        types = ('clothing', 'electronics', 'miscellaneous')
+        calls = [
+            self.request(
+                'POST', '/register', f'bench-user-{i % 50}',
+                json={
+                    'name': f'parcel {i}',
+                    'weight': self.random.uniform(0.1, 30),
+                    'parcel_type': types[i % 3],
+                    'content_cost': self.random.uniform(1, 1000),
+                },
+            )
+            for i in range(self.args.requests)
+        ]
+        result, _ = await run_requests(calls, self.args.concurrency)
+        self.record('register', result)
+
+    async def register_batch(self) -> None:
+        """
+        register the same parcels one request at a time in a loop and as
+        batches of batch_size, rows per second of both and their ratio
+        """
+        types = ('clothing', 'electronics', 'miscellaneous')
+        size = self.args.batch_size
+        batches = 5
+
+        def parcels():
+            return [
+                {
+                    'name': f'parcel {i}',
+                    'weight': self.random.uniform(0.1, 30),
+                    'parcel_type': types[i % 3],
+                    'content_cost': self.random.uniform(1, 1000),
+                }
+                for i in range(size)
+            ]
+
+        calls = [
+            self.request('POST', '/register', 'bench-loop', json=parcel)
+            for parcel in parcels()
+        ]
+        # one row per request, requests per second are rows per second
+        single, _ = await run_requests(calls, 1)
+        self.record(f'register loop {size}', single)
+
+        calls = [
+            self.request('POST', '/register/batch', 'bench-batch', json=batch)
+            for batch in [parcels() for _ in range(batches)]
+        ]
+        batch, responses = await run_requests(calls, 1)
+        batch['errors'] += sum(
+            None in response.json()['ids']
+            for response in responses if response.status_code == 200
+        )
+        # rows, not requests, per second
+        batch['throughput'] = round(batch['throughput'] * size, 1)
+        batch['speedup'] = round(batch['throughput'] / single['throughput'], 1)
+        self.record(f'register batch {size}', batch)
+        sys.stdout.write(
+            f'register batch {size}: {batch["speedup"]}x the rows per second'
+            f' of the single endpoint in a loop\n'
+        )
+
+    async def user_parcels(self, parcel_ids: list[int]) -> None:
+        from app.cache import parcel_cache
+        from app.pagination import encode_cursor
+
+        pages = len(parcel_ids) // PAGE_SIZE
+        shallow = [self.random.randrange(5) for _ in range(self.args.requests)]
+        deep = [
+            self.random.randrange(max(pages - 50, 1), pages)
+            for _ in range(self.args.requests)
+        ]
+
+        def by_offset(page):
+            return self.request(
+                'GET', '/user-parcels', DEEP_SESSION,
+                params={'limit': PAGE_SIZE, 'skip_pages': page * PAGE_SIZE},
+            )
+
+        def by_cursor(page):
+            return self.request(
+                'GET', '/user-parcels', DEEP_SESSION,
+                params={
+                    'limit': PAGE_SIZE,
+                    'cursor': encode_cursor(parcel_ids[page * PAGE_SIZE - 1]),
+                },
+            )
+
+        for name, calls in (
+            ('user-parcels shallow', [by_offset(page) for page in shallow]),
+            ('user-parcels deep offset', [by_offset(page) for page in deep]),
+            ('user-parcels deep cursor', [by_cursor(page) for page in deep]),
+        ):
+            result, _ = await run_requests(calls, self.args.concurrency)
+            self.record(name, result)
+
+        parcel_cache.ttl = 60
+        try:
+            result, _ = await run_requests(
+                [by_offset(page) for page in shallow], self.args.concurrency
+            )
+        finally:
+            parcel_cache.ttl = 0
+        self.record('user-parcels shallow cached', result)
+
+        calls = [
+            self.request(
+                'GET', '/parcel-by-id', DEEP_SESSION,
+                params={'parcel_id': self.random.choice(parcel_ids)},
+            )
+            for _ in range(self.args.requests)
+        ]
+        result, _ = await run_requests(calls, self.args.concurrency)
+        self.record('parcel-by-id', result)
+
+        calls = [
+            self.request(
+                'GET', '/search', DEEP_SESSION,
+                params={
+                    'limit': PAGE_SIZE,
+                    'name': str(self.random.randrange(100, 1000)),
+                    'min_weight': 1,
+                    'max_weight': 20,
+                },
+            )
+            for _ in range(self.args.requests)
+        ]
+        result, _ = await run_requests(calls, self.args.concurrency)
+        self.record('search', result)
+
+        calls = [
+            self.request('GET', '/summary', DEEP_SESSION)
+            for _ in range(self.args.requests)
+        ]
+        result, _ = await run_requests(calls, self.args.concurrency)
+        self.record('summary', result)
+
+    async def assign_company(self, company_ids: list[int]) -> None:
+        """
+        every company tries to claim every parcel, exactly one claim per
+        parcel may win
+        """
+        parcels = self.args.contention_parcels
+        parcel_ids = await seed_parcels('bench-assign', parcels)
+        calls = [
+            self.request(
+                'PUT', '/assign-company', 'bench-courier',
+                params={'parcel_id': parcel_id, 'company_id': company_id},
+            )
+            for parcel_id in parcel_ids
+            for company_id in company_ids
+        ]
+        self.random.shuffle(calls)
+        result, responses = await run_requests(
+            calls, self.args.concurrency, expected=(200, 409)
+        )
+        won = sum(response.status_code == 200 for response in responses)
+        result['errors'] += abs(won - parcels)
+        self.record('assign-company contention', result)
+
+        parcel_ids = await seed_parcels('bench-assign-batch', parcels)
+        groups = [
+            parcel_ids[start:start + PAGE_SIZE]
+            for start in range(0, parcels, PAGE_SIZE)
+        ]
+        calls = [
+            self.request(
+                'PUT', '/assign-company/batch', 'bench-courier',
+                json={
+                    'company_id': company_id,
+                    'parcel_ids': self.random.sample(group, len(group)),
+                },
+            )
+            for group in groups
+            for company_id in company_ids
+        ]
+        self.random.shuffle(calls)
+        result, responses = await run_requests(calls, self.args.concurrency)
+        won = sum(
+            outcome == 'won'
+            for response in responses if response.status_code == 200
+            for outcome in response.json()['results'].values()
+        )
+        result['errors'] += abs(won - parcels)
+        self.record('assign-company batch contention', result)
+
+    async def delivery_costs(self, rows: int) -> None:
+        from sqlalchemy import delete
+
+        from app.db import database
+        from app.models import Parcel
+        from app.repositories import ParcelRepository
+
+        async with database.session_factory() as db_session:
+            await db_session.execute(delete(Parcel))
+            await db_session.commit()
+        await seed_parcels('bench-costs', rows, return_ids=False)
+
+        chunks = []
+        chunk_started = time.perf_counter()
+
+        async def on_chunk(last_id, session_ids):
+            nonlocal chunk_started
+            now = time.perf_counter()
+            chunks.append(now - chunk_started)
+            chunk_started = now
+
+        async with database.session_factory() as db_session:
+            started = chunk_started = time.perf_counter()
+            priced = await ParcelRepository.calculate_delivery_costs(
+                db_session, EXCHANGE_RATE, on_chunk=on_chunk
+            )
+            elapsed = time.perf_counter() - started
+        result = summarize(chunks, elapsed, abs(priced - rows))
+        # throughput of the job is rows, not chunks, per second
+        result.update(requests=len(chunks), throughput=round(rows / elapsed))
+        self.record(f'calculate_delivery_costs {rows}', result)
+
+
+async def seed_parcels(
+        session_id: str, count: int, return_ids: bool = True
+) -> list[int]:
+    """
+    insert unpriced parcels of one user directly, bypassing the API, and
+    recount its summary
+    :return: ids of its unassigned parcels in ascending order
+    """
+    from sqlalchemy import insert, select
+
+    from app.db import database
+    from app.models import Parcel
+    from app.repositories import ParcelSummaryRepository, UserRepository
+
+    rng = random.Random(count)
+    async with database.session_factory() as db_session:
+        await UserRepository.upsert(db_session, session_id)
+        for start in range(0, count, 50000):
+            await db_session.execute(insert(Parcel), [
+                {
+                    'name': f'parcel {i}',
+                    'weight': rng.uniform(0.1, 30),
+                    'parcel_type_id': i % 3 + 1,
+                    'content_value': rng.uniform(1, 1000),
+                    'user_session_id': session_id,
+                }
+                for i in range(start, min(start + 50000, count))
+            ])
+        await ParcelSummaryRepository.rebuild(db_session, [session_id])
+        await db_session.commit()
+        if not return_ids:
+            return []
+        return list(await db_session.scalars(
+            select(Parcel.id).where(
+                Parcel.user_session_id == session_id,
+                Parcel.delivery_company_id.is_(None),
+            ).order_by(Parcel.id)
+        ))
+
+
+async def create_schema(companies: int) -> list[int]:
+    """
+    :return: ids of the seeded delivery companies
+    """
+    from sqlalchemy import insert
+
+    from app.db import database
+    from app.models import Base, Company, ParcelType
+
+    async with database.engine.begin() as connection:
+        if connection.dialect.name == 'sqlite':
+            await connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.execute(insert(ParcelType), [
+            {'id': 1, 'name': 'clothing'},
+            {'id': 2, 'name': 'electronics'},
+            {'id': 3, 'name': 'miscellaneous'},
+        ])
+        await connection.execute(insert(Company), [
+            {'id': i, 'name': f'company {i}'}
+            for i in range(1, companies + 1)
+        ])
+    return list(range(1, companies + 1))
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    :return: descriptions of the regressions against the baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(
+                f'{name}: throughput {result["throughput"]}'
+                f' < {before["throughput"]}'
+            )
+        for key in ('p95_ms', 'p99_ms'):
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append(
+                    f'{name}: {key} {result[key]} > {before[key]}'
+                )
+        if result['errors'] > before['errors']:
+            regressions.append(
+                f'{name}: errors {result["errors"]} > {before["errors"]}'
+            )
+    return regressions
+
+
+async def run(args) -> dict:
+    from app.app import app
+    from app.delivery_costs import delivery_cost_batcher
+
+    # the delivery cost celery task is not part of the request path
+    delivery_cost_batcher.publish = lambda parcel_ids: None
+
+    company_ids = await create_schema(args.companies)
+    deep_ids = await seed_parcels(DEEP_SESSION, args.deep_rows)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url='http://bench'
+        ) as client:
+            bench = Bench(client, args)
+            sys.stdout.write(
+                f'{"scenario":<32} {"requests":>8} {"errors":>6}'
+                f' {"per second":>10} {"p50 ms":>9} {"p95 ms":>9}'
+                f' {"p99 ms":>9}\n'
+            )
+            await bench.register()
+            await bench.register_batch()
+            await bench.user_parcels(deep_ids)
+            await bench.assign_company(company_ids)
+            for rows in args.rows:
+                await bench.delivery_costs(rows)
+    return bench.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10 ** 4])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--deep-rows', type=int, default=10000)
+    parser.add_argument('--contention-parcels', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--companies', type=int, default=10)
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--db-url')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        configure(
+            args.db_url or f'sqlite+aiosqlite:///{directory}/bench.db'
+        )
+        results = asyncio.run(run(args))
+
+    regressions = []
+    if args.baseline.exists() and not args.update_baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare(
+            results, baseline['scenarios'], args.tolerance
+        )
+    else:
+        args.baseline.write_text(json.dumps({
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'scenarios': results,
+        }, indent=2))
+        sys.stdout.write(f'baseline saved to {args.baseline}\n')
+
+    for regression in regressions:
+        sys.stdout.write(f'REGRESSION {regression}\n')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Query plan regression check, MySQL only.
+
+Runs every repository query inside a transaction that is rolled back at
+the end, captures the SQL it sends, runs EXPLAIN for each statement and
+exits with a non-zero status when a checked table is read with a full
+table or full index scan.
+
+    python -m benchmarks.query_plans [seed rows]
+
+The optimizer prefers full scans on tiny tables, so synthetic parcels are
+inserted first (10000 by default) inside the same rolled back transaction,
+together with the company they are assigned to, so no fixture data is
+needed.
+"""
+import asyncio
+import sys
+
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import logger
+from app.db import database
+from app.models import Company
+from app.pydantic_models.pydantic_models import EParcelType, ParcelPD
+from app.repositories import (ParcelRepository, ParcelTypeRepository,
+                              UserRepository)
+
+# tables that must always be reached through an index
+CHECKED_TABLES = ('parcel',)
+# EXPLAIN access types reading the whole table or the whole index
+FULL_SCAN_TYPES = ('ALL', 'index')
+
+SESSION_ID = 'query-plan-check'
+
+
+def repository_queries(parcel_id: int, company_id: int) -> dict:
+    """
+    :param parcel_id: id of a seeded parcel
+    :param company_id: id of the seeded company
+    :return: name -> coroutine function running repository code on a session
+    """
+    first_page = {'limit': 10, 'skip_pages': 0, 'after_id': None}
+    next_page = {'limit': 10, 'skip_pages': 0, 'after_id': parcel_id}
+    return {
+        'ParcelRepository.get_all_by_session_id': (
+            lambda s: ParcelRepository.get_all_by_session_id(
+                s, SESSION_ID, first_page
+            )
+        ),
+        'ParcelRepository.get_all_by_session_id[cursor]': (
+            lambda s: ParcelRepository.get_all_by_session_id(
+                s, SESSION_ID, next_page
+            )
+        ),
+        'ParcelRepository.get_all_by_session_id[type, cost]': (
+            lambda s: ParcelRepository.get_all_by_session_id(
+                s, SESSION_ID, next_page, True, EParcelType.clothing
+            )
+        ),
+        'ParcelRepository.search_by_session_id': (
+            lambda s: ParcelRepository.search_by_session_id(
+                s, SESSION_ID, first_page, name='12',
+                min_weight=1, max_weight=20,
+            )
+        ),
+        'ParcelRepository.search_by_session_id[cursor, ranges]': (
+            lambda s: ParcelRepository.search_by_session_id(
+                s, SESSION_ID, next_page,
+                min_weight=1, max_weight=20,
+                min_content_value=1, max_content_value=1000,
+            )
+        ),
+        'ParcelRepository.get_full_info_by_id': (
+            lambda s: ParcelRepository.get_full_info_by_id(
+                s, SESSION_ID, parcel_id
+            )
+        ),
+        'ParcelRepository.calculate_delivery_costs': (
+            lambda s: ParcelRepository.calculate_delivery_costs(s, 1.0)
+        ),
+        'ParcelRepository.assign_company': (
+            lambda s: ParcelRepository.assign_company(
+                s, company_id, parcel_id
+            )
+        ),
+    }
+
+
+async def seed(db_session: AsyncSession, rows: int) -> tuple[int, int]:
+    """
+    :return: id of a parcel in the middle of the seeded ones (0 if none
+        could be seeded) and id of the seeded company
+    """
+    await UserRepository.upsert(db_session, SESSION_ID)
+    res = await db_session.execute(insert(Company).values(name=SESSION_ID))
+    company_id = res.inserted_primary_key[0]
+    parcel_types = await ParcelTypeRepository.get_all(db_session) or []
+    if not parcel_types:
+        logger.warning('parcel_types is empty, plans are checked unseeded')
+        return 0, company_id
+    parcels = []
+    for i in range(rows):
+        parcel_type = parcel_types[i % len(parcel_types)]
+        parcel = ParcelPD(
+            name=f'parcel {i}',
+            weight=1,
+            parcel_type=EParcelType(parcel_type.name),
+            content_cost=1,
+        )
+        parcels.append((parcel, parcel_type.id))
+    ids = await ParcelRepository.create_many(
+        db_session, parcels, SESSION_ID
+    )
+    return ids[len(ids) // 2] if ids else 0, company_id
+
+
+async def check_query_plans(seed_rows: int = 10000) -> list[str]:
+    """
+    :return: list of problems found, empty if every plan uses an index
+    """
+    problems = []
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(
+            ('SELECT', 'UPDATE', 'DELETE')
+        ):
+            captured.append((statement, parameters))
+
+    async with database.engine.connect() as connection:
+        transaction = await connection.begin()
+        # repository commits only release savepoints of the outer transaction
+        db_session = AsyncSession(
+            bind=connection, join_transaction_mode='create_savepoint'
+        )
+        try:
+            queries = repository_queries(*await seed(db_session, seed_rows))
+            for name, run in queries.items():
+                captured.clear()
+                event.listen(
+                    connection.sync_engine, 'before_cursor_execute', capture
+                )
+                try:
+                    await run(db_session)
+                finally:
+                    event.remove(
+                        connection.sync_engine,
+                        'before_cursor_execute',
+                        capture
+                    )
+                for statement, parameters in captured:
+                    plan = await connection.exec_driver_sql(
+                        f'EXPLAIN {statement}', parameters
+                    )
+                    for row in plan.mappings().all():
+                        logger.info(
+                            f'{name}: table={row["table"]} '
+                            f'type={row["type"]} key={row["key"]} '
+                            f'rows={row["rows"]}'
+                        )
+                        if (
+                            row['table'] in CHECKED_TABLES
+                            and row['type'] in FULL_SCAN_TYPES
+                        ):
+                            problems.append(
+                                f'{name}: full scan ({row["type"]}) of '
+                                f'{row["table"]} in: {statement}'
+                            )
+        finally:
+            await db_session.close()
+            await transaction.rollback()
+    await database.engine.dispose()
+    return problems
+
+
+if __name__ == '__main__':
+    found = asyncio.run(
+        check_query_plans(*(int(arg) for arg in sys.argv[1:2]))
+    )
+    for problem in found:
+        logger.error(problem)
+    sys.exit(1 if found else 0)
@@ -0,0 +1,91 @@
+"""
+Per-row CPU cost of parcel list serialization.
+
+Compares the former ParcelDetailResponse + jsonable_encoder + JSONResponse
+path with ParcelSerializer on 10, 100 and 1000 rows.
+
+    python -m benchmarks.serialization
+"""
+import sys
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from app.models import Parcel, ParcelType
+from app.pydantic_models.pydantic_models import ParcelDetailResponse
+from app.serializers import ParcelSerializer
+
+ROW_COUNTS = (10, 100, 1000)
+
+
+def make_rows(count: int) -> list[tuple[Parcel, ParcelType]]:
+    parcel_types = [
+        ParcelType(id=1, name='clothing'), ParcelType(id=2, name='electronics')
+    ]
+    return [
+        (
+            Parcel(
+                id=i,
+                name=f'parcel {i}',
+                weight=1.5 + i,
+                parcel_type_id=i % 2 + 1,
+                content_value=100.0 + i,
+                delivery_cost=12.5 if i % 2 else None,
+                delivery_company_id=1 if i % 3 else None,
+            ),
+            parcel_types[i % 2],
+        )
+        for i in range(count)
+    ]
+
+
+def pydantic_path(rows) -> bytes:
+    serialized_parcels = [
+        ParcelDetailResponse(
+            id=parcel.id,
+            name=parcel.name,
+            weight=parcel.weight,
+            parcel_type=parcel_type.name,
+            content_value=parcel.content_value,
+            delivery_cost=parcel.delivery_cost
+            if parcel.delivery_cost
+            else 'No info yet.',
+            delivery_company_id=parcel.delivery_company_id
+            if parcel.delivery_company_id
+            else 'Not assigned yet.',
+        )
+        for parcel, parcel_type in rows
+    ]
+    return JSONResponse(content=jsonable_encoder(serialized_parcels)).body
+
+
+def serializer_path(rows) -> bytes:
+    return ParcelSerializer.dump_many(rows)
+
+
+def per_row_microseconds(func, rows) -> float:
+    number = max(1, 20000 // len(rows))
+    best = min(timeit.repeat(lambda: func(rows), number=number, repeat=5))
+    return best / number / len(rows) * 1e6
+
+
+def main():
+    sys.stdout.write(
+        f'{"rows":>6} {"pydantic us/row":>16} {"serializer us/row":>18}'
+        f' {"speedup":>8}\n'
+    )
+    for count in ROW_COUNTS:
+        rows = make_rows(count)
+        # both paths must produce byte-identical documents
+        assert pydantic_path(rows) == serializer_path(rows)
+        before = per_row_microseconds(pydantic_path, rows)
+        after = per_row_microseconds(serializer_path, rows)
+        sys.stdout.write(
+            f'{count:>6} {before:>16.2f} {after:>18.2f}'
+            f' {before / after:>7.1f}x\n'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Per-request overhead of the session middleware.
+
+Drives a trivial endpoint through ASGI calls (no network) with the
+former BaseHTTPMiddleware implementation and with the pure ASGI one,
+for returning clients and for new sessions, at a given concurrency.
+
+    python -m benchmarks.session_middleware [requests] [concurrency]
+"""
+import asyncio
+import secrets
+import sys
+import time
+from datetime import datetime, timedelta
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from app.middleware.session_middleware import SessionMiddleware
+
+
+class BaseHTTPSessionMiddleware(BaseHTTPMiddleware):
+    """
+    previous implementation, kept here as the baseline
+    """
+
+    async def dispatch(self, request, call_next):
+        session_id = request.cookies.get('session_id')
+        if not session_id:
+            session_id = secrets.token_hex(16)
+            response = await call_next(request)
+            cookie_expires = (
+                datetime.utcnow() + timedelta(days=365)
+            ).strftime('%a, %d %b %Y %H:%M:%S GMT')
+            response.set_cookie(
+                key='session_id',
+                value=session_id,
+                expires=cookie_expires
+            )
+            return response
+        return await call_next(request)
+
+
+async def endpoint(request):
+    return PlainTextResponse('ok')
+
+
+def build_app(middleware_class):
+    return Starlette(
+        routes=[Route('/', endpoint)],
+        middleware=[Middleware(middleware_class)],
+    )
+
+
+async def call(app, headers):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': '/', 'raw_path': b'/',
+        'root_path': '', 'query_string': b'', 'headers': headers,
+        'client': ('127.0.0.1', 1), 'server': ('127.0.0.1', 80),
+    }
+
+    body_sent = False
+    response_complete = asyncio.Event()
+
+    async def receive():
+        nonlocal body_sent
+        if body_sent:
+            # like uvicorn, report disconnect once the response is sent
+            await response_complete.wait()
+            return {'type': 'http.disconnect'}
+        body_sent = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if (
+            message['type'] == 'http.response.body'
+            and not message.get('more_body', False)
+        ):
+            response_complete.set()
+
+    await app(scope, receive, send)
+
+
+async def measure(app, headers, requests: int, concurrency: int) -> float:
+    """
+    :return: microseconds per request
+    """
+    async def worker(count):
+        for _ in range(count):
+            await call(app, headers)
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(worker(requests // concurrency) for _ in range(concurrency))
+    )
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+async def main(requests: int = 20000, concurrency: int = 50):
+    cases = {
+        'returning client': [(b'cookie', b'session_id=' + b'a' * 32)],
+        'new session': [],
+    }
+    sys.stdout.write(
+        f'{requests} requests, concurrency {concurrency}\n'
+        f'{"case":<18} {"BaseHTTP us/req":>16} {"ASGI us/req":>12}'
+        f' {"speedup":>8}\n'
+    )
+    for case, headers in cases.items():
+        before = await measure(
+            build_app(BaseHTTPSessionMiddleware), headers,
+            requests, concurrency
+        )
+        after = await measure(
+            build_app(SessionMiddleware), headers, requests, concurrency
+        )
+        sys.stdout.write(
+            f'{case:<18} {before:>16.1f} {after:>12.1f}'
+            f' {before / after:>7.1f}x\n'
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:3])))
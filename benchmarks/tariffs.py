@@ -0,0 +1,106 @@
+"""
+Vectorized tariff pricing throughput.
+
+Prices synthetic parcels with a rule set covering parcel types, weight
+bands, a weight step table and a company rule. The result is checked
+against a per-row python reference on a sample. Exits non-zero when the
+batch takes longer than the time budget.
+
+    python -m benchmarks.tariffs [parcels] [budget seconds]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from app.pydantic_models.pydantic_models import ParcelTypePD, TariffRulePD
+from app.registries import parcel_type_registry
+from app.tariffs import NO_COMPANY, TariffEngine
+
+PARCEL_TYPES = (
+    ParcelTypePD(id=1, name='clothing'),
+    ParcelTypePD(id=2, name='electronics'),
+    ParcelTypePD(id=3, name='miscellaneous'),
+)
+RULES = [
+    TariffRulePD(
+        parcel_type='electronics', max_weight=1, base=100, content_rate=0.02
+    ),
+    TariffRulePD(parcel_type='electronics', per_kg=0.7, content_rate=0.02),
+    TariffRulePD(company_id=2, per_kg=0.4, content_rate=0.01),
+    TariffRulePD(
+        parcel_type='clothing',
+        weight_steps=[(1, 50), (5, 120), (20, 300)],
+        per_kg=10,
+        content_rate=0.005,
+    ),
+    TariffRulePD(min_weight=50, base=500, per_kg=0.3, content_rate=0.01),
+]
+EXCHANGE_RATE = 90.5
+SAMPLE_SIZE = 10000
+
+
+def make_parcels(count: int) -> tuple[np.ndarray, ...]:
+    rng = np.random.default_rng(0)
+    return (
+        rng.integers(1, 4, count),
+        rng.uniform(0.1, 80, count),
+        rng.uniform(10, 100000, count),
+        # a third of the parcels is not assigned yet
+        rng.integers(NO_COMPANY, 3, count),
+    )
+
+
+def reference_price(engine, parcel_type_id, weight, content_value,
+                    company_id) -> float:
+    names = {item.id: item.name for item in PARCEL_TYPES}
+    for rule in engine.rules:
+        if (
+            (rule.parcel_type is None
+             or rule.parcel_type.value == names[parcel_type_id])
+            and (rule.company_id is None or rule.company_id == company_id)
+            and weight >= rule.min_weight
+            and (rule.max_weight is None or weight < rule.max_weight)
+        ):
+            break
+    if rule.weight_steps is None:
+        weight_price = weight * rule.per_kg
+    else:
+        limit, price = next(
+            (step for step in rule.weight_steps if weight <= step[0]),
+            rule.weight_steps[-1],
+        )
+        weight_price = price + max(weight - limit, 0) * rule.per_kg
+    return (
+        rule.base + (weight_price + content_value * rule.content_rate)
+    ) * EXCHANGE_RATE
+
+
+def main(count: int = 1000000, budget: float = 0.5):
+    parcel_type_registry.update(PARCEL_TYPES)
+    engine = TariffEngine(RULES)
+    parcels = make_parcels(count)
+
+    costs = engine.price(*parcels, EXCHANGE_RATE)
+    for index in range(0, count, max(1, count // SAMPLE_SIZE)):
+        expected = reference_price(
+            engine, *(column[index].item() for column in parcels)
+        )
+        assert costs[index] == expected, (index, costs[index], expected)
+
+    elapsed = min(timeit.repeat(
+        lambda: engine.price(*parcels, EXCHANGE_RATE), number=1, repeat=5
+    ))
+    sys.stdout.write(
+        f'{count} parcels, {len(engine.rules)} rules: {elapsed:.3f}s '
+        f'({count / elapsed:,.0f} parcels/s), budget {budget:.3f}s\n'
+    )
+    if elapsed > budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(
+        *(int(arg) for arg in sys.argv[1:2]),
+        *(float(arg) for arg in sys.argv[2:3]),
+    )